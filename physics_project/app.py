@@ -1,24 +1,33 @@
+import ast
 import csv
+import hashlib
 import io
 import json
 import logging
 import math
+import multiprocessing
 import os
 import random
 import re
+import signal
+import threading
 import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from decimal import Decimal
 from datetime import datetime
 from functools import wraps
-from math import pi, log
 
+import mpmath
 import mysql.connector
 import numpy as np
 import redis
 import sympy as sp
 from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, abort
 from openpyxl import load_workbook
+from sympy.functions.elementary.piecewise import ExprCondPair
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -29,17 +38,105 @@ logger = logging.getLogger(__name__)
 # Redis 配置
 redis_url = os.getenv('REDIS_URL', 'redis://172.17.66.87:6379/0')
 redis_client = redis.Redis.from_url(redis_url, decode_responses=True)
-POOL_TARGET = 50
-POOL_LOW_WATER = 25
-POOL_REFILL_BATCH = 10
+# 题目池容量按需求自适应：每个模板在 Redis 中记录出池请求速率的 EWMA（道/分钟），
+# 目标容量 = 速率 × POOL_COVER_MINUTES（限制在 [POOL_MIN_TARGET, POOL_MAX_TARGET]），低水位为目标的 POOL_LOW_WATER_RATIO
+POOL_TARGET = 50  # 没有出池记录时的默认目标容量；启动预热时作为下限，应对开考时的集中出题
+POOL_MIN_TARGET = 10
+POOL_MAX_TARGET = 500
+POOL_COVER_MINUTES = 2  # 题目池应能支撑的出池时长
+POOL_LOW_WATER_RATIO = 0.5
+POOL_DEMAND_HALF_LIFE_SECONDS = 60  # 出池速率 EWMA 的半衰期
+POOL_DEMAND_TAU_SECONDS = POOL_DEMAND_HALF_LIFE_SECONDS / math.log(2)
+POOL_DEMAND_TTL_SECONDS = 24 * 3600
+POOL_REFILL_BATCH = 10  # 请求线程兜底生成与审核抽样的批量
+# 设为 1 时题目池由独立的补货守护进程（refill_daemon.py，start_multi_4.bat 会启动）补货：请求线程发现池低于水位时只发布低水位事件
+# 默认由各实例在本地进程池中补货
+POOL_REFILL_DAEMON = os.getenv('POOL_REFILL_DAEMON', '0').strip() == '1'
+POOL_LOW_WATER_CHANNEL = 'exam:events:pool_low_water'
+POOL_LOW_WATER_NOTIFY_SECONDS = 5  # 同一模板低水位事件的最短发布间隔
 PROBLEM_TTL_SECONDS = int(os.getenv('PROBLEM_TTL_SECONDS', 900))
 
 TEMPLATE_CACHE = {}
 TEMPLATE_CACHE_TS = 0
-
-PROBLEM_POOL_TARGET_SIZE = int(os.getenv('PROBLEM_POOL_TARGET_SIZE', 20))
-PROBLEM_POOL_REFILL_BATCH = int(os.getenv('PROBLEM_POOL_REFILL_BATCH', 10))
-PROBLEM_TTL_SECONDS = int(os.getenv('PROBLEM_TTL_SECONDS', 900))
+# 编译后的模板（公式数值函数、网格模式的合格组合表等），按 (模板ID, 修订号) 缓存；LRU，按条数与估算内存双重限制
+COMPILED_TEMPLATE_CACHE = OrderedDict()
+COMPILED_TEMPLATE_CACHE_SIZE = int(os.getenv('COMPILED_TEMPLATE_CACHE_SIZE', 256))
+COMPILED_TEMPLATE_CACHE_MAX_BYTES = int(os.getenv('COMPILED_TEMPLATE_CACHE_MAX_MB', 512)) * 1024 * 1024
+COMPILED_TEMPLATE_BASE_BYTES = 256 * 1024  # 每个编译结果中 sympy 表达式与数值函数的估算占用（numpy 数组另按实际字节数计）
+COMPILED_TEMPLATE_CACHE_LOCK = threading.Lock()
+# 模板修改后通过 Redis 频道通知所有实例清除该模板的进程内缓存；题目池中旧修订的题目在出池时丢弃
+TEMPLATE_CHANGE_CHANNEL = 'exam:events:template_changed'
+STALE_REVISIONS = set()  # 已确认过期的 (模板ID, 修订号)，避免旧题目每次出池都查询数据库
+POOL_STALE_DROP_LIMIT = 100  # 每次出池最多丢弃的旧修订题目数
+
+# 题目变体由 (模板ID, 修订号, seed) 唯一确定；按需重建后放入进程内 LRU 缓存
+VARIANT_DECIMALS = 2  # 变量采样网格默认保留的小数位
+# 变量采样方式：lhs 为拉丁超立方（每批样本均匀铺满范围，减少相近变体），random 为独立均匀采样
+VARIANT_SAMPLER = os.getenv('VARIANT_SAMPLER', 'lhs')
+# 网格模式：配置范围内的网格点组合数不超过该值时，一次性枚举全部组合并只保留合格行，出题时直接随机取行
+GRID_MAX_COMBINATIONS = int(os.getenv('GRID_MAX_COMBINATIONS', 200000))
+GRID_FLAG_TTL_SECONDS = 24 * 3600  # 网格模式标记的有效期（模板修改时清除）
+VARIANT_CACHE_SIZE = int(os.getenv('VARIANT_CACHE_SIZE', 4096))
+VARIANT_CACHE = OrderedDict()
+VARIANT_CACHE_LOCK = threading.Lock()
+
+# 变量采样范围学习：各实例共享 Redis 中的接受/拒绝统计与合格区间
+LEARNED_RANGE_MIN_ACCEPTED = 20  # 合格样本数达到该值后才使用学习到的区间
+LEARNED_RANGE_MARGIN = 0.1  # 在观测到的合格区间两侧各留出的探索余量（占区间宽度）
+LEARNED_RANGE_CACHE_SECONDS = 60
+LEARNED_RANGE_TTL_SECONDS = 30 * 24 * 3600
+LEARNED_RANGE_CACHE = {}
+
+# 含积分等符号运算的公式：每个模板修订只求一次闭式解，缓存在 Redis 中供各实例复用
+CLOSED_FORM_TTL_SECONDS = 30 * 24 * 3600
+CLOSED_FORM_CHECK_ROWS = 3  # 新求出的闭式解与逐行符号求值对比的样本数
+
+# 管理员保存模板后在独立的进程池中做生成审核（不占用出题的进程池）：抽样生成并统计耗时、拒绝率、回退率与答案分布
+TEMPLATE_AUDIT_WORKERS = int(os.getenv('TEMPLATE_AUDIT_WORKERS', 1))
+TEMPLATE_AUDIT_EXECUTOR = None
+TEMPLATE_AUDIT_SAMPLES = 2000
+TEMPLATE_AUDIT_HARD_LIMIT_SECONDS = 120
+TEMPLATE_AUDIT_TTL_SECONDS = 30 * 24 * 3600
+TEMPLATE_AUDIT_MAX_MEAN_MS = 20  # 每道题平均生成耗时上限（毫秒）
+TEMPLATE_AUDIT_MAX_P99_MS = 200
+TEMPLATE_AUDIT_MAX_REJECTION_RATE = 0.9
+TEMPLATE_AUDIT_MAX_FALLBACK_RATE = 0.05
+# 保存模板前在进程池中试编译（含闭式解求解、区间分析）并抽样求值
+TEMPLATE_CHECK_HARD_LIMIT_SECONDS = 30
+TEMPLATE_CHECK_ROWS = 20
+
+# 学生已见变体：每个 (学生, 模板) 一个固定大小的 Bloom 过滤器（Redis 位图），出题时跳过已见过的变体
+SEEN_FILTER_BITS = 4096  # 每个过滤器 512 字节；见过 200 个变体时误判率约 0.3%
+SEEN_FILTER_HASHES = 3
+SEEN_FILTER_TTL_SECONDS = 120 * 24 * 3600  # 约一个学期，每次写入时续期
+SEEN_MAX_SKIPS = 3  # 每次出题最多跳过的已见变体数
+
+# 离线题目变体库：build_variant_bank.py 预先生成，文件名包含模板ID与修订号，各实例以内存映射方式读取
+VARIANT_BANK_DIR = os.getenv('VARIANT_BANK_DIR', 'variant_banks')
+VARIANT_BANK_RECHECK_SECONDS = 60  # 变体库文件不存在时，间隔多久重新检查
+VARIANT_BANKS = {}
+
+# 题目生成在独立进程池中执行，避免公式求值（尤其是符号积分）长时间占用 waitress 请求线程
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', 2))
+GENERATION_TIME_BUDGET_SECONDS = float(os.getenv('GENERATION_TIME_BUDGET_SECONDS', 2.0))  # 请求线程最多等待的时间
+GENERATION_HARD_LIMIT_SECONDS = 60  # 单个生成任务的硬性上限，超时在子进程内中止
+GENERATION_BREAKER_FAILURES = 3  # 连续超出时间预算或失败的次数达到该值后熔断
+GENERATION_BREAKER_COOLDOWN_SECONDS = 300
+GENERATION_EXECUTOR = None
+GENERATION_INFLIGHT = {}  # 模板ID -> 正在执行的生成任务
+COMPILE_INFLIGHT = set()  # 正在进程池中编译的 (模板ID, 修订号)
+GENERATION_FAILURES = {}  # 模板ID -> 连续失败次数
+GENERATION_LOCK = threading.Lock()
+# 跨实例补货锁：同一模板同时只有一个实例生成，其余实例阻塞等待题目入池；锁在任务完成时释放，超时自动过期
+GENERATION_REFILL_LOCK_SECONDS = GENERATION_HARD_LIMIT_SECONDS + 10
+
+# 启动预热：多实例同时启动时通过 Redis 锁选出一个实例执行，各模板分发到独立进程池并行补满题目池，进度写入 Redis
+PREWARM_WORKERS = int(os.getenv('PREWARM_WORKERS', os.cpu_count() or 2))
+PREWARM_LOCK_KEY = 'exam:prewarm:lock'
+PREWARM_LOCK_TTL_SECONDS = 300  # 每完成一个模板续期一次，持锁实例退出后锁自动过期
+PREWARM_STATUS_KEY = 'exam:prewarm:status'
+PREWARM_STATUS_TTL_SECONDS = 24 * 3600
+INSTANCE_ID = f"{os.getenv('PORT', '5000')}:{uuid.uuid4().hex[:8]}"  # 标识持锁实例
 
 # 数据库配置
 db_config = {
@@ -314,27 +411,362 @@ def get_pool_key(template_id):
     return f"exam:pool:{template_id}"
 
 
+def get_template_audit_key(template_id):
+    return f"exam:audit:{template_id}"
+
+
+def get_seen_filter_key(user_id, template_id):
+    return f"exam:seen:{user_id}:{template_id}"
+
+
+def get_pool_members_key(template_id):
+    """题目池去重集合：记录池中现有的题目引用，相同变体不会重复入池"""
+    return f"exam:pool:{template_id}:members"
+
+
+def get_pool_low_water_key(template_id):
+    """低水位事件节流标记：存在期间不再重复发布该模板的低水位事件"""
+    return f"exam:pool:{template_id}:low_water"
+
+
+def get_pool_demand_key(template_id):
+    """出池速率 EWMA：rate（道/分钟，截至 ts）与 ts（秒）"""
+    return f"exam:pool:{template_id}:demand"
+
+
+def get_pool_grid_key(template_id):
+    """网格模式标记：存在时该模板直接从合格组合表出题，预热与补货守护进程不再补充其题目池"""
+    return f"exam:pool:{template_id}:grid"
+
+
+def get_refill_lock_key(template_id):
+    return f"exam:pool:{template_id}:refilling"
+
+
 def get_problem_key(token):
     return f"exam:problem:{token}"
 
 
+def get_learned_range_key(template_id, revision):
+    return f"exam:learned:{template_id}:{revision}"
+
+
+def get_closed_form_key(template_id, revision):
+    return f"exam:closed_form:{template_id}:{revision}"
+
+
+# 合并一批采样统计：每个变量累加接受/拒绝次数，并扩展观测到的合格区间
+RECORD_SAMPLING_STATS_SCRIPT = redis_client.register_script("""
+for i = 2, #ARGV, 5 do
+    local var = ARGV[i]
+    local accepted = tonumber(ARGV[i + 1])
+    redis.call('HINCRBY', KEYS[1], var .. ':accepted', accepted)
+    redis.call('HINCRBY', KEYS[1], var .. ':rejected', ARGV[i + 2])
+    if accepted > 0 then
+        local current_min = redis.call('HGET', KEYS[1], var .. ':min')
+        if not current_min or tonumber(ARGV[i + 3]) < tonumber(current_min) then
+            redis.call('HSET', KEYS[1], var .. ':min', ARGV[i + 3])
+        end
+        local current_max = redis.call('HGET', KEYS[1], var .. ':max')
+        if not current_max or tonumber(ARGV[i + 4]) > tonumber(current_max) then
+            redis.call('HSET', KEYS[1], var .. ':max', ARGV[i + 4])
+        end
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+""")
+
+
+# 去重入池：只有集合中不存在的题目引用才写入题目池，新题目按块用一条多值 LPUSH 写入，返回实际入池数
+PUSH_UNIQUE_PROBLEMS_SCRIPT = redis_client.register_script("""
+local fresh = {}
+for i = 1, #ARGV do
+    if redis.call('SADD', KEYS[2], ARGV[i]) == 1 then
+        fresh[#fresh + 1] = ARGV[i]
+    end
+end
+for i = 1, #fresh, 1000 do
+    redis.call('LPUSH', KEYS[1], unpack(fresh, i, math.min(i + 999, #fresh)))
+end
+return #fresh
+""")
+
+# 出池时同时从去重集合中移除，之后同一变体可以再次入池
+POP_POOLED_PROBLEM_SCRIPT = redis_client.register_script("""
+local raw = redis.call('RPOP', KEYS[1])
+if raw then
+    redis.call('SREM', KEYS[2], raw)
+end
+return raw
+""")
+
+
+# 出池并签发 token（单次往返）：取出题目、从去重集合中移除、以 token 写入并设置 TTL，
+# ARGV[6] 为当前修订号（非空时）：引用中不含该修订的旧题目直接丢弃，最多丢弃 ARGV[7] 条；
+# 每次出池请求计入该模板的出池速率 EWMA，并据此计算目标容量与低水位（与 get_pool_targets 的计算一致）；
+# 出池后低于水位且模板未熔断时发布低水位事件（同一模板按节流标记最多每 ARGV[2] 秒一次）。
+# 返回 {题目引用, 剩余数量, 目标容量}
+POP_AND_ISSUE_TOKEN_SCRIPT = redis_client.register_script("""
+local now = tonumber(ARGV[8])
+local tau = tonumber(ARGV[9])
+local demand = redis.call('HMGET', KEYS[6], 'rate', 'ts')
+local rate = 0
+if demand[1] and demand[2] then
+    rate = tonumber(demand[1]) * math.exp(-math.max(0, now - tonumber(demand[2])) / tau)
+end
+rate = rate + 60 / tau
+redis.call('HSET', KEYS[6], 'rate', rate, 'ts', now)
+redis.call('EXPIRE', KEYS[6], ARGV[14])
+local target = math.min(tonumber(ARGV[12]), math.max(tonumber(ARGV[11]), math.ceil(rate * tonumber(ARGV[10]))))
+local low_water = math.max(1, math.ceil(target * tonumber(ARGV[13])))
+
+local raw = redis.call('RPOP', KEYS[1])
+local dropped = 0
+while raw and ARGV[6] ~= '' and not string.find(raw, ':' .. ARGV[6] .. ':', 1, true) do
+    redis.call('SREM', KEYS[2], raw)
+    dropped = dropped + 1
+    -- 达到丢弃上限时本次不出题，剩余的旧修订题目留给下次出池
+    if dropped >= tonumber(ARGV[7]) then
+        raw = false
+    else
+        raw = redis.call('RPOP', KEYS[1])
+    end
+end
+if raw then
+    redis.call('SREM', KEYS[2], raw)
+    redis.call('SET', KEYS[3], raw, 'EX', ARGV[1])
+end
+local remaining = redis.call('LLEN', KEYS[1])
+if ARGV[5] == '1' and remaining < low_water and redis.call('EXISTS', KEYS[5]) == 0
+        and redis.call('SET', KEYS[4], 1, 'NX', 'EX', ARGV[2]) then
+    redis.call('PUBLISH', ARGV[3], ARGV[4])
+end
+return {raw, remaining, target}
+""")
+
+# 只有持锁实例（值与 ARGV[1] 相同）才能释放或续期锁
+RELEASE_LOCK_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+RENEW_LOCK_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+def push_pooled_problems(template_id, problems, client=None):
+    """把题目去重后写入题目池（整批一次往返）；传入 pipeline 作为 client 时只排队，结果在 execute() 中返回"""
+    if not problems:
+        return 0
+    return PUSH_UNIQUE_PROBLEMS_SCRIPT(
+        keys=[get_pool_key(template_id), get_pool_members_key(template_id)],
+        args=[dump_problem_payload(problem_data) for problem_data in problems],
+        client=client)
+
+
+def pop_pooled_problem(template_id):
+    """从题目池取出一条题目引用（原始字符串），池为空时返回 None"""
+    return POP_POOLED_PROBLEM_SCRIPT(keys=[get_pool_key(template_id), get_pool_members_key(template_id)])
+
+
+def wait_pooled_problem(template_id, timeout):
+    """阻塞等待题目入池（BRPOP，题目入池时立即返回），超时返回 None"""
+    result = redis_client.brpop(get_pool_key(template_id), timeout=timeout)
+    if not result:
+        return None
+    raw = result[1]
+    redis_client.srem(get_pool_members_key(template_id), raw)
+    return raw
+
+
+def pop_pooled_problem_with_token(template_id, token, revision=None):
+    """从题目池取出一条题目并直接以 token 写入 Redis（单次往返），同时记录出池速率。
+
+    指定 revision 时丢弃途中遇到的旧修订题目（最多 POOL_STALE_DROP_LIMIT 条，超过时本次返回 None）。
+    返回 (原始题目引用或 None, 剩余数量, 目标容量)。
+    """
+    raw, remaining, target = POP_AND_ISSUE_TOKEN_SCRIPT(
+        keys=[get_pool_key(template_id), get_pool_members_key(template_id), get_problem_key(token),
+              get_pool_low_water_key(template_id), get_generation_breaker_key(template_id),
+              get_pool_demand_key(template_id)],
+        args=[PROBLEM_TTL_SECONDS, POOL_LOW_WATER_NOTIFY_SECONDS, POOL_LOW_WATER_CHANNEL, template_id,
+              int(POOL_REFILL_DAEMON), revision or '', POOL_STALE_DROP_LIMIT, time.time(),
+              POOL_DEMAND_TAU_SECONDS, POOL_COVER_MINUTES, POOL_MIN_TARGET, POOL_MAX_TARGET,
+              POOL_LOW_WATER_RATIO, POOL_DEMAND_TTL_SECONDS])
+    return raw, remaining, target
+
+
+def get_pool_low_water(target):
+    return max(1, math.ceil(target * POOL_LOW_WATER_RATIO))
+
+
+def get_pool_targets(template_ids, pipe=None):
+    """按出池速率 EWMA（衰减到当前时刻）计算各模板题目池的目标容量；没有出池记录时为 POOL_TARGET。
+
+    传入 pipeline 时与其中已排队的命令一起执行，返回 (目标容量列表, pipeline 中其余命令的结果)。
+    """
+    template_ids = list(template_ids)
+    own_pipe = pipe is None
+    pipe = pipe or redis_client.pipeline(transaction=False)
+    for template_id in template_ids:
+        pipe.hmget(get_pool_demand_key(template_id), 'rate', 'ts')
+    results = pipe.execute()
+    queued, demands = results[:len(results) - len(template_ids)], results[len(results) - len(template_ids):]
+    now = time.time()
+    targets = []
+    for rate, updated_at in demands:
+        if rate is None or updated_at is None:
+            targets.append(POOL_TARGET)
+            continue
+        rate = float(rate) * math.exp(-max(0.0, now - float(updated_at)) / POOL_DEMAND_TAU_SECONDS)
+        targets.append(min(POOL_MAX_TARGET, max(POOL_MIN_TARGET, math.ceil(rate * POOL_COVER_MINUTES))))
+    return targets if own_pipe else (targets, queued)
+
+
+def dump_problem_payload(problem_data):
+    """序列化题目：带 seed 的题目保存紧凑引用「模板ID:修订号:seed（36 进制）:变量=值,...:答案,...」（约 60~100 字节），
+    读取时只需按模板文本拼接题面，不必再求值公式；没有 seed 的题目保存完整 JSON。
+    """
+    if problem_data.get('seed') is not None:
+        seed = np.base_repr(problem_data['seed'], 36).lower()
+        values = ','.join(f"{var}={float(value)!r}" for var, value in problem_data['var_values'].items())
+        answers = ','.join(repr(float(answer)) for answer in problem_data['correct_answers'])
+        return f"{problem_data['template_id']}:{problem_data['revision']}:{seed}:{values}:{answers}"
+    return json.dumps(problem_data)
+
+
+def load_problem_payload(raw):
+    """反序列化题目：紧凑引用由其中的变量值与答案拼装，完整 JSON 直接返回；无法解析时返回 None。
+
+    兼容旧的引用「模板ID:修订号:seed」与 JSON [模板ID, 修订号, seed]（按 seed 重建，模板已修改时返回 None）。
+    """
+    if not raw.startswith(('[', '{')):
+        try:
+            parts = raw.split(':')
+            if len(parts) == 3:
+                template_id, revision, seed = parts
+                return get_problem_by_variant(int(template_id), revision, int(seed, 36))
+            template_id, revision, seed, values, answers = parts
+            var_values = {}
+            for item in filter(None, values.split(',')):
+                var, value = item.split('=')
+                var_values[var] = float(value)
+            correct_answers = [float(answer) for answer in answers.split(',')]
+            return build_problem_from_payload(int(template_id), revision, int(seed, 36), var_values,
+                                              correct_answers)
+        except ValueError:
+            return None
+    try:
+        payload = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(payload, list) and len(payload) == 3:
+        return get_problem_by_variant(*payload)
+    if isinstance(payload, dict):
+        return payload
+    return None
+
+
+def get_problem_layout(template_id, revision):
+    """拼接题面所需的模板信息（文本片段、显示小数位、答案单位），不编译公式。
+
+    优先使用本进程已编译的该修订；否则由模板行解析。模板已修改（当前修订号不同）时返回 None，
+    不用新模板文本拼接旧修订的变量值与答案。
+    """
+    with COMPILED_TEMPLATE_CACHE_LOCK:
+        compiled = COMPILED_TEMPLATE_CACHE.get((template_id, revision))
+    if compiled is not None:
+        return compiled
+    template = get_template(template_id)
+    if not template or get_template_revision(template) != revision:
+        return None
+    variables, _, variable_specs = parse_variable_specs(template.get('variables', ''))
+    text_literals, text_slots = split_problem_text(template.get('problem_text', ''), set(variables))
+    return {
+        'template': template,
+        'text_literals': text_literals,
+        'text_slots': text_slots,
+        'var_decimals': {var: spec['decimals'] for var, spec in variable_specs.items() if 'decimals' in spec},
+        'answer_units': parse_answer_units(template),
+    }
+
+
+def build_problem_from_payload(template_id, revision, seed, var_values, correct_answers):
+    """由紧凑引用中的变量值与答案拼装题目数据（与 build_problem_data 的字段一致）"""
+    layout = get_problem_layout(template_id, revision)
+    if not layout:
+        return None
+    template = layout['template']
+    answer_units = list(layout['answer_units'][:len(correct_answers)])
+    answer_units.extend([''] * (len(correct_answers) - len(answer_units)))
+    return {
+        'problem_text': render_problem_text(layout, var_values),
+        'var_values': var_values,
+        'correct_answers': correct_answers,
+        'answer_units': answer_units,
+        'template_id': template_id,
+        'answer_count': len(correct_answers),
+        'template_name': template['template_name'],
+        'image_filename': template.get('image_filename'),
+        'revision': revision,
+        'seed': seed
+    }
+
+
 def cache_problem_with_token(token, problem_data):
-    """将题目数据写入Redis并设置TTL"""
-    redis_client.setex(get_problem_key(token), PROBLEM_TTL_SECONDS, json.dumps(problem_data))
+    """将题目引用写入Redis并设置TTL"""
+    remember_variant(problem_data)
+    redis_client.setex(get_problem_key(token), PROBLEM_TTL_SECONDS, dump_problem_payload(problem_data))
 
 
 def get_problem_by_token(token):
-    """通过token从Redis获取题目数据"""
+    """通过token从Redis获取题目数据（静态模板的token直接指向缓存的题目，不经过Redis）"""
     if not token:
         return None
-    raw = redis_client.get(get_problem_key(token))
+    if token.startswith(STATIC_TOKEN_PREFIX):
+        _, template_id, revision = token.split(':')
+        compiled = get_compiled_template(int(template_id), revision)
+        return get_static_problem(compiled) if compiled else None
+    # GETEX（Redis 6.2+）读取的同时续期，每次读取只需一次往返
+    raw = redis_client.getex(get_problem_key(token), ex=PROBLEM_TTL_SECONDS)
     if not raw:
         return None
-    try:
-        redis_client.expire(get_problem_key(token), PROBLEM_TTL_SECONDS)
-        return json.loads(raw)
-    except json.JSONDecodeError:
+    return load_problem_payload(raw)
+
+
+def remember_variant(problem_data):
+    if problem_data.get('seed') is None:
+        return
+    key = (problem_data['template_id'], problem_data['revision'], problem_data['seed'])
+    with VARIANT_CACHE_LOCK:
+        VARIANT_CACHE[key] = problem_data
+        VARIANT_CACHE.move_to_end(key)
+        while len(VARIANT_CACHE) > VARIANT_CACHE_SIZE:
+            VARIANT_CACHE.popitem(last=False)
+
+
+def get_problem_by_variant(template_id, revision, seed):
+    """按 (模板ID, 修订号, seed) 获取题目：优先读进程内缓存，否则确定性地重建"""
+    key = (template_id, revision, seed)
+    with VARIANT_CACHE_LOCK:
+        problem_data = VARIANT_CACHE.get(key)
+        if problem_data is not None:
+            VARIANT_CACHE.move_to_end(key)
+            return problem_data
+
+    compiled = get_compiled_template(template_id, revision)
+    if not compiled:
         return None
+    problem_data = build_problem_from_seed(compiled, seed)
+    remember_variant(problem_data)
+    return problem_data
 
 
 def load_template_from_db(template_id):
@@ -361,82 +793,783 @@ def get_template(template_id):
     return template
 
 
-def refill_problem_pool(template_id, count):
-    """生成题目并补充到池中"""
-    created = 0
-    for _ in range(count):
-        problem_data = generate_problem_from_template(template_id)
-        if problem_data:
-            redis_client.lpush(get_pool_key(template_id), json.dumps(problem_data))
-            created += 1
-    return created
+def get_generation_breaker_key(template_id):
+    return f"exam:breaker:{template_id}"
 
 
-def ensure_problem_pool(template_id):
-    """低水位补货（小批量）"""
-    current_size = redis_client.llen(get_pool_key(template_id))
-    if current_size < POOL_LOW_WATER:
-        refill_problem_pool(template_id, POOL_REFILL_BATCH)
+def get_generation_executor():
+    global GENERATION_EXECUTOR
+    with GENERATION_LOCK:
+        if GENERATION_EXECUTOR is None:
+            # spawn 启动子进程，避免在多线程的 waitress 进程中 fork
+            GENERATION_EXECUTOR = ProcessPoolExecutor(
+                max_workers=GENERATION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return GENERATION_EXECUTOR
 
 
-def fetch_problem_from_pool(template_id):
-    """从池中获取题目，如果不足则补充"""
-    ensure_problem_pool(template_id)
-    raw_problem = redis_client.rpop(get_pool_key(template_id))
+def _raise_generation_timeout(signum, frame):
+    raise TimeoutError("题目生成超过硬性时间上限")
 
-    if not raw_problem:
-        problem_data = generate_problem_from_template(template_id)
-        if not problem_data:
-            return None, None
-        token = uuid.uuid4().hex
-        cache_problem_with_token(token, problem_data)
-        return token, problem_data
 
-    if not raw_problem:
-        return None, None
+def run_with_hard_limit(seconds, func, *args):
+    """在进程池子进程中执行 func，超过 seconds 秒时抛出 TimeoutError（不支持 SIGALRM 的平台不限时）"""
+    use_alarm = hasattr(signal, 'SIGALRM')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_generation_timeout)
+        signal.alarm(seconds)
+    try:
+        return func(*args)
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+def _compile_and_generate(template_id, count):
+    """先编译（子进程内首次使用该模板时），再生成并计时；返回 (题目列表, 生成耗时秒数)"""
+    compiled = get_compiled_template(template_id)
+    if compiled and get_variant_grid(compiled) is not None:
+        # 仍生成这一批：尚未完成后台编译的实例会从池中取题
+        mark_grid_template(template_id)
+    started = time.perf_counter()
+    problems = generate_problems_batch(template_id, count)
+    return problems, time.perf_counter() - started
+
+
+def _generate_problems_in_worker(template, count):
+    """进程池子进程中执行：使用主进程传入的模板生成题目（子进程不访问数据库）。
+
+    返回 (题目列表, 生成耗时)：耗时在子进程内测量，不含子进程启动、排队与编译的时间。
+    """
+    TEMPLATE_CACHE[template['id']] = template
+    return run_with_hard_limit(GENERATION_HARD_LIMIT_SECONDS, _compile_and_generate, template['id'], count)
 
+
+def validate_template_definition(variables, solution_formula):
+    """只解析变量定义与公式并按白名单检查（不编译），不合法时抛出 ValueError"""
+    variable_names, _, variable_specs = parse_variable_specs(variables)
+    compile_variable_rules(variable_names, variable_specs)
     try:
-        problem_data = json.loads(raw_problem)
-    except json.JSONDecodeError:
-        return None, None
+        tree = ast.parse((solution_formula or '').strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"公式语法错误: {e.msg}")
+    validate_formula_tree(tree, variable_names)
+
+
+def check_existing_templates():
+    """启动时检查数据库中已有模板能否通过公式白名单（旧版按 eval 保存，未经校验），返回不合法的模板ID列表"""
+    conn = get_db_connection()
+    if not conn:
+        return []
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT id, template_name, variables, solution_formula FROM problem_templates")
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+    invalid = []
+    for row in rows:
+        try:
+            validate_template_definition(row['variables'], row['solution_formula'])
+        except (ValueError, TypeError) as e:
+            invalid.append(row['id'])
+            logger.error("模板 %s（%s）无法通过公式检查，出题将失败: %s", row['id'], row['template_name'], e)
+            print(f"⚠️ 模板 {row['id']} {row['template_name']} 无法通过公式检查: {e}")
+    if invalid:
+        print(f"⚠️ 共 {len(invalid)} 个模板需要在管理后台修改公式后才能出题")
+    return invalid
+
+
+def check_template_definition(variables, solution_formula, answer_count=1, answer_units=None,
+                              answer_constraints=None):
+    """保存模板前的检查：变量定义与公式能否解析，并在进程池中试编译、抽样求值（与出题时的编译过程一致），
+    不合法、超时或在变量范围内求不出有限答案时抛出 ValueError"""
+    validate_template_definition(variables, solution_formula)
+
+    # 试编译不写入闭式解缓存（id 为 None），也不占用请求进程的 CPU
+    template = {
+        'id': None, 'problem_text': '', 'variables': variables, 'solution_formula': solution_formula,
+        'answer_count': answer_count or 1, 'answer_units': answer_units, 'answer_constraints': answer_constraints,
+    }
+    future = get_generation_executor().submit(_check_template_in_worker, template)
+    try:
+        future.result(timeout=TEMPLATE_CHECK_HARD_LIMIT_SECONDS + 5)
+    except TimeoutError:
+        # 仍在排队（进程池正忙于出题）时撤销任务，不误报为公式过慢
+        if future.cancel():
+            raise ValueError("后台出题任务繁忙，暂时无法检查公式，请稍后重试")
+        raise ValueError(f"公式编译超过 {TEMPLATE_CHECK_HARD_LIMIT_SECONDS} 秒，请简化公式")
+
+
+def _check_template_in_worker(template):
+    """进程池子进程中执行：试编译模板并抽样求值，失败时统一抛出 ValueError"""
+    try:
+        compiled = run_with_hard_limit(TEMPLATE_CHECK_HARD_LIMIT_SECONDS, compile_template, template)
+        rng = np.random.default_rng(0)
+        columns = sample_variable_matrix(compiled, compiled['ranges'], 0, TEMPLATE_CHECK_ROWS, rng)
+        answers = evaluate_compiled_formula(compiled, columns, TEMPLATE_CHECK_ROWS)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"公式无法编译: {type(e).__name__}: {e}")
+    if not np.isfinite(answers).any(axis=1).all():
+        raise ValueError("公式在变量范围内求不出有限的答案，请检查变量范围与公式")
+
+
+def audit_template(template_id):
+    """抽样生成 TEMPLATE_AUDIT_SAMPLES 道题，统计每道题的生成耗时、拒绝率、回退率与答案分布。
+
+    逐道生成并分别计时（与请求线程兜底出题的单题耗时一致），P99 为单题耗时的 99 分位；
+    审核不写入采样统计，耗时不含 Redis 往返。
+    """
+    compiled = get_compiled_template(template_id)
+    if not compiled:
+        return {'status': 'failed', 'error': '公式无法编译'}
+
+    report = {'sampled': 0, 'rejected': 0, 'generated': 0, 'fallback': 0}
+    per_problem_ms = []
+    answers = []
+    while report['generated'] + report['fallback'] < TEMPLATE_AUDIT_SAMPLES:
+        started = time.perf_counter()
+        problems = generate_problems_batch(template_id, 1, report=report, quiet=True)
+        if not problems:
+            break
+        per_problem_ms.append((time.perf_counter() - started) * 1000)
+        answers.extend(problem_data['correct_answers'] for problem_data in problems)
+    if not answers:
+        return {'status': 'failed', 'error': '无法生成题目'}
+
+    answer_matrix = np.array(answers, dtype=np.float64)
+    total = report['generated'] + report['fallback']
+    result = {
+        'revision': compiled['revision'],
+        'template_kind': compiled['template_kind'],
+        'samples': total,
+        'mean_ms': round(float(np.mean(per_problem_ms)), 3),
+        'p99_ms': round(float(np.percentile(per_problem_ms, 99)), 3),
+        'rejection_rate': round(report['rejected'] / report['sampled'], 4) if report['sampled'] else 0.0,
+        'fallback_rate': round(report['fallback'] / total, 4),
+        'answers': [
+            {
+                'unit': compiled['answer_units'][index],
+                'min': float(np.min(column)),
+                'p50': float(np.median(column)),
+                'max': float(np.max(column)),
+            }
+            for index, column in enumerate(answer_matrix.T)
+        ],
+    }
+
+    warnings = []
+    if result['mean_ms'] > TEMPLATE_AUDIT_MAX_MEAN_MS:
+        warnings.append(f"平均生成耗时 {result['mean_ms']}ms 超过 {TEMPLATE_AUDIT_MAX_MEAN_MS}ms")
+    if result['p99_ms'] > TEMPLATE_AUDIT_MAX_P99_MS:
+        warnings.append(f"P99 生成耗时 {result['p99_ms']}ms 超过 {TEMPLATE_AUDIT_MAX_P99_MS}ms")
+    if result['rejection_rate'] > TEMPLATE_AUDIT_MAX_REJECTION_RATE:
+        warnings.append(f"拒绝率 {result['rejection_rate']:.0%} 过高，请检查变量范围")
+    if result['fallback_rate'] > TEMPLATE_AUDIT_MAX_FALLBACK_RATE:
+        warnings.append(f"回退率 {result['fallback_rate']:.0%} 过高，请检查变量范围与公式")
+    result['warnings'] = warnings
+    result['status'] = 'flagged' if warnings else 'ok'
+    return result
+
+
+def _audit_template_in_worker(template):
+    """进程池子进程中执行模板生成审核"""
+    TEMPLATE_CACHE[template['id']] = template
+    return run_with_hard_limit(TEMPLATE_AUDIT_HARD_LIMIT_SECONDS, audit_template, template['id'])
+
+
+def save_template_audit(template_id, revision, result):
+    """保存模板生成审核结果（供管理页面展示）"""
+    result.setdefault('revision', revision)
+    result['finished_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        redis_client.setex(get_template_audit_key(template_id), TEMPLATE_AUDIT_TTL_SECONDS,
+                           json.dumps(result, ensure_ascii=False))
+    except redis.RedisError as e:
+        logger.error("写入模板 %s 审核结果失败: %s", template_id, e)
+    if result['status'] != 'ok':
+        print(f"⚠️ 模板 {template_id} 生成审核未通过: {result.get('warnings') or result.get('error')}")
+
+
+def get_template_audit_executor():
+    global TEMPLATE_AUDIT_EXECUTOR
+    with GENERATION_LOCK:
+        if TEMPLATE_AUDIT_EXECUTOR is None:
+            TEMPLATE_AUDIT_EXECUTOR = ProcessPoolExecutor(
+                max_workers=TEMPLATE_AUDIT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return TEMPLATE_AUDIT_EXECUTOR
+
+
+def _finish_template_audit(template_id, revision, future):
+    global TEMPLATE_AUDIT_EXECUTOR
+    try:
+        result = future.result()
+    except Exception as e:
+        result = {'status': 'failed', 'error': str(e)}
+        if isinstance(e, BrokenProcessPool):
+            with GENERATION_LOCK:
+                TEMPLATE_AUDIT_EXECUTOR = None
+    save_template_audit(template_id, revision, result)
+
+
+def submit_template_audit(template_id):
+    """管理员保存模板后提交后台生成审核，结果写入 Redis 供管理页面展示"""
+    template = load_template_from_db(template_id)
+    if not template:
+        return
+    revision = get_template_revision(template)
+    try:
+        redis_client.setex(get_template_audit_key(template_id), TEMPLATE_AUDIT_TTL_SECONDS,
+                           json.dumps({'status': 'running', 'revision': revision}))
+    except redis.RedisError as e:
+        logger.warning("写入模板 %s 审核状态失败: %s", template_id, e)
+    future = get_template_audit_executor().submit(_audit_template_in_worker, template)
+    future.add_done_callback(lambda f: _finish_template_audit(template_id, revision, f))
+
+
+def get_template_audits(template_ids):
+    """批量读取模板的生成审核结果：模板ID -> 结果字典（没有记录时不包含）"""
+    if not template_ids:
+        return {}
+    try:
+        raw_results = redis_client.mget([get_template_audit_key(template_id) for template_id in template_ids])
+    except redis.RedisError as e:
+        logger.warning("读取模板审核结果失败: %s", e)
+        return {}
+    return {template_id: json.loads(raw) for template_id, raw in zip(template_ids, raw_results) if raw}
+
+
+def is_generation_suspended(template_id):
+    """模板是否处于熔断期（熔断状态存放在 Redis 中，各实例共享）"""
+    try:
+        return bool(redis_client.exists(get_generation_breaker_key(template_id)))
+    except redis.RedisError:
+        return False
+
+
+def record_generation_result(template_id, succeeded):
+    """记录生成结果；连续超出时间预算或失败达到阈值时熔断该模板"""
+    with GENERATION_LOCK:
+        if succeeded:
+            GENERATION_FAILURES.pop(template_id, None)
+            return
+        failures = GENERATION_FAILURES.get(template_id, 0) + 1
+        GENERATION_FAILURES[template_id] = failures
+        if failures < GENERATION_BREAKER_FAILURES:
+            return
+        GENERATION_FAILURES.pop(template_id, None)
+
+    try:
+        redis_client.setex(get_generation_breaker_key(template_id), GENERATION_BREAKER_COOLDOWN_SECONDS, failures)
+    except redis.RedisError as e:
+        logger.warning("写入模板 %s 熔断状态失败: %s", template_id, e)
+    print(f"🚫 模板 {template_id} 连续 {failures} 次生成超时或失败，暂停生成 {GENERATION_BREAKER_COOLDOWN_SECONDS} 秒")
+
 
+def reset_generation_executor(executor, error):
+    """进程池损坏（子进程异常退出）或已关闭时不可再用，丢弃后下次提交时重建；executor 为 None 时不比较实例"""
+    global GENERATION_EXECUTOR
+    if not isinstance(error, (BrokenProcessPool, RuntimeError)):
+        return
+    with GENERATION_LOCK:
+        if executor is None or GENERATION_EXECUTOR is executor:
+            GENERATION_EXECUTOR = None
+
+
+def _finish_generation(template_id, future, time_budget=GENERATION_TIME_BUDGET_SECONDS):
+    """生成任务完成回调：结果写入题目池（即使请求线程已不再等待），并更新熔断计数。
+
+    只有失败、超过硬性上限或子进程内的生成耗时超过 time_budget 才计入熔断；进程启动与排队等待不计入。
+    """
+    try:
+        problems, elapsed = future.result()
+    except Exception as e:
+        logger.error("模板 %s 生成任务失败: %s", template_id, e)
+        problems, elapsed = None, None
+        if isinstance(e, BrokenProcessPool):
+            reset_generation_executor(None, e)
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        push_pooled_problems(template_id, problems, client=pipe)
+        RELEASE_LOCK_SCRIPT(keys=[get_refill_lock_key(template_id)], args=[INSTANCE_ID], client=pipe)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error("模板 %s 生成结果入池失败: %s", template_id, e)
+
+    record_generation_result(template_id, bool(problems) and elapsed <= time_budget)
+    with GENERATION_LOCK:
+        task = GENERATION_INFLIGHT.pop(template_id, None)
+    if task:
+        task['done'].set()
+
+
+def submit_generation(template_id, count, time_budget=GENERATION_TIME_BUDGET_SECONDS):
+    """把生成任务提交到进程池，同一模板同时只执行一个任务；返回任务信息（含完成事件）。
+
+    同一实例内共享正在执行的任务；其他实例持有该模板的补货锁时不重复生成，返回 None。
+    耗时超过 time_budget 秒的任务计入熔断失败次数。
+    """
+    with GENERATION_LOCK:
+        task = GENERATION_INFLIGHT.get(template_id)
+    if task:
+        return task
+
+    template = get_template(template_id)
+    if not template:
+        return None
+    executor = get_generation_executor()
+    with GENERATION_LOCK:
+        task = GENERATION_INFLIGHT.get(template_id)
+        if task:
+            return task
+        if not redis_client.set(get_refill_lock_key(template_id), INSTANCE_ID,
+                                nx=True, ex=GENERATION_REFILL_LOCK_SECONDS):
+            return None
+        task = {'done': threading.Event()}
+        GENERATION_INFLIGHT[template_id] = task
+    try:
+        future = executor.submit(_generate_problems_in_worker, template, count)
+    except Exception as e:
+        # 提交失败（进程池已损坏或已关闭）：撤销登记并释放补货锁，等待中的请求立即改用其他来源
+        logger.error("模板 %s 生成任务提交失败: %s", template_id, e)
+        reset_generation_executor(executor, e)
+        with GENERATION_LOCK:
+            GENERATION_INFLIGHT.pop(template_id, None)
+        try:
+            RELEASE_LOCK_SCRIPT(keys=[get_refill_lock_key(template_id)], args=[INSTANCE_ID])
+        except redis.RedisError as redis_error:
+            logger.warning("释放模板 %s 补货锁失败: %s", template_id, redis_error)
+        record_generation_result(template_id, False)
+        task['done'].set()
+        return task
+    future.add_done_callback(lambda f: _finish_generation(template_id, f, time_budget))
+    return task
+
+
+def mark_grid_template(template_id):
+    try:
+        redis_client.setex(get_pool_grid_key(template_id), GRID_FLAG_TTL_SECONDS, 1)
+    except redis.RedisError as e:
+        logger.warning("写入模板 %s 网格模式标记失败: %s", template_id, e)
+
+
+def _compile_with_grid(template_id):
+    """编译模板并枚举合格组合表，返回 {ranges, grid}；公式无法编译时返回 None"""
+    compiled = get_compiled_template(template_id)
+    if not compiled:
+        return None
+    grid = get_variant_grid(compiled)
+    if grid is not None:
+        mark_grid_template(template_id)
+    return {'ranges': compiled['ranges'], 'grid': grid}
+
+
+def _compile_template_in_worker(template):
+    """进程池子进程中执行：编译模板（求闭式解并写入 Redis 缓存、区间分析）并枚举网格模式的合格组合表，
+    返回推算出的采样范围与合格组合表"""
+    TEMPLATE_CACHE[template['id']] = template
+    return run_with_hard_limit(GENERATION_HARD_LIMIT_SECONDS, _compile_with_grid, template['id'])
+
+
+def _finish_template_compile(template, cache_key, future):
+    """编译任务完成回调：闭式解从 Redis 缓存读取、采样范围与合格组合表直接使用子进程的结果，在本进程重建编译结果"""
+    try:
+        result = future.result()
+        if result is not None:
+            compiled = compile_template(template, result['ranges'])
+            compiled['grid'] = result['grid']
+            cache_compiled_template(cache_key, compiled)
+    except Exception as e:
+        logger.error("模板 %s 后台编译失败: %s", template['id'], e)
+        if isinstance(e, BrokenProcessPool):
+            reset_generation_executor(None, e)
+    finally:
+        with GENERATION_LOCK:
+            COMPILE_INFLIGHT.discard(cache_key)
+
+
+def submit_template_compile(template):
+    """把模板编译（求闭式解、区间分析等 sympy 运算）提交到进程池，不占用请求线程；同一修订同时只编译一次"""
+    cache_key = (template['id'], get_template_revision(template))
+    with GENERATION_LOCK:
+        if cache_key in COMPILE_INFLIGHT:
+            return
+        COMPILE_INFLIGHT.add(cache_key)
+    executor = get_generation_executor()
+    try:
+        future = executor.submit(_compile_template_in_worker, template)
+    except Exception as e:
+        logger.error("模板 %s 编译任务提交失败: %s", template['id'], e)
+        reset_generation_executor(executor, e)
+        with GENERATION_LOCK:
+            COMPILE_INFLIGHT.discard(cache_key)
+        return
+    future.add_done_callback(lambda f: _finish_template_compile(template, cache_key, f))
+
+
+def refill_problem_pool(template_id, count, timeout=None, time_budget=GENERATION_TIME_BUDGET_SECONDS):
+    """在进程池中批量生成题目并补充到池中。
+
+    timeout 为最多等待的秒数（None 表示等到完成，0 表示不等待）；超时后任务继续在后台执行，完成后照常入池。
+    返回任务是否已在等待时间内完成（其他实例正在补货时返回 False）。
+    """
+    task = submit_generation(template_id, count, time_budget)
+    if task is None:
+        return False
+    if timeout == 0:
+        return task['done'].is_set()
+    return task['done'].wait(timeout)
+
+
+def ensure_problem_pool(template_id, pool_size, target):
+    """未启用补货守护进程时的低水位补货：在本实例进程池中补到目标容量，不阻塞请求。
+
+    启用守护进程时低水位事件由出池脚本发布，这里不做任何事。
+    """
+    if (not POOL_REFILL_DAEMON and pool_size < get_pool_low_water(target)
+            and not is_generation_suspended(template_id)):
+        refill_problem_pool(template_id, max(POOL_REFILL_BATCH, target - pool_size), timeout=0)
+
+
+def get_cached_variant(template_id):
+    """从本进程缓存的变体中随机取一道当前修订的题目，没有时返回 None"""
+    template = get_template(template_id)
+    if not template:
+        return None
+    revision = get_template_revision(template)
+    with VARIANT_CACHE_LOCK:
+        candidates = [problem_data for (cached_id, cached_revision, _), problem_data in VARIANT_CACHE.items()
+                      if cached_id == template_id and cached_revision == revision]
+    return random.choice(candidates) if candidates else None
+
+
+def take_generated_problem(template_id, revision=None):
+    """池为空时：在时间预算内等待进程池生成并取一道题；超时或模板熔断时改用缓存的变体
+
+    取自题目池的题目修订号与模板当前修订不同时丢弃。
+    """
+    revision = revision or get_current_revision(template_id)
+    if not is_generation_suspended(template_id):
+        task = submit_generation(template_id, POOL_REFILL_BATCH)
+        if task is not None:
+            task['done'].wait(GENERATION_TIME_BUDGET_SECONDS)
+            raw_problem = pop_pooled_problem(template_id)
+        else:
+            # 其他实例正在为该模板补货：阻塞等待其结果入池，不重复生成
+            raw_problem = wait_pooled_problem(template_id, GENERATION_TIME_BUDGET_SECONDS)
+        problem_data = load_problem_payload(raw_problem) if raw_problem else None
+        if problem_data and problem_data.get('revision') == revision:
+            return problem_data
+
+    problem_data = get_cached_variant(template_id)
+    if problem_data:
+        print(f"⏱️ 模板 {template_id} 生成超出时间预算或已熔断，使用缓存的变体")
+    return problem_data
+
+
+def get_variant_bank_path(template_id, revision, bank_dir=None):
+    return os.path.join(bank_dir or VARIANT_BANK_DIR, f"template_{template_id}_{revision}.npy")
+
+
+def build_variant_bank(template_id, size, bank_dir=None):
+    """为模板当前修订预生成 size 个已校验变体，保存为结构化 .npy（values: 变量值，answers: 正确答案）
+
+    返回 (文件路径, 实际行数)；模板不存在或公式无法编译时返回 (None, 0)。
+    """
+    compiled = get_compiled_template(template_id)
+    if not compiled:
+        return None, 0
+
+    problems = generate_problems_batch(template_id, size, fallback=False)
+    dtype = [('values', np.float64, (len(compiled['variables']),)),
+             ('answers', np.float64, (compiled['answer_count'],))]
+    bank = np.zeros(len(problems), dtype=dtype)
+    for row, problem_data in enumerate(problems):
+        bank[row]['values'] = [problem_data['var_values'][var] for var in compiled['variables']]
+        bank[row]['answers'] = problem_data['correct_answers']
+
+    path = get_variant_bank_path(template_id, compiled['revision'], bank_dir)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, bank)
+    os.replace(temp_path, path)
+    return path, len(bank)
+
+
+def load_variant_bank(compiled):
+    """以内存映射方式加载模板当前修订的变体库，不存在时返回 None"""
+    cache_key = (compiled['template_id'], compiled['revision'])
+    cached = VARIANT_BANKS.get(cache_key)
+    if cached and (cached[1] is not None or time.time() - cached[0] < VARIANT_BANK_RECHECK_SECONDS):
+        return cached[1]
+
+    bank = None
+    path = get_variant_bank_path(*cache_key)
+    if os.path.exists(path):
+        try:
+            bank = np.load(path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.warning("加载变体库 %s 失败: %s", path, e)
+    VARIANT_BANKS[cache_key] = (time.time(), bank)
+    return bank
+
+
+def fetch_problem_from_bank(compiled):
+    """从离线变体库随机取一行构建题目（无求值、无校验、无 Redis 访问）；没有变体库时返回 None"""
+    if not compiled:
+        return None
+    bank = load_variant_bank(compiled)
+    if bank is None or len(bank) == 0:
+        return None
+
+    row = bank[random.randrange(len(bank))]
+    var_values = dict(zip(compiled['variables'], row['values'].tolist()))
+    return build_problem_data(compiled, var_values, row['answers'].tolist(),
+                              encode_variant_seed(compiled, var_values))
+
+
+STATIC_TOKEN_PREFIX = 'static:'
+
+
+def get_static_problem(compiled):
+    """静态模板（没有采样变量）只有一道题，渲染一次后缓存在编译结果中"""
+    if 'static_problem' not in compiled:
+        compiled['static_problem'] = build_problem_from_seed(compiled, 0)
+    return compiled['static_problem']
+
+
+def get_seen_filter_offsets(problem_data):
+    """变体在 Bloom 过滤器中的位偏移：对 (修订号, seed) 做哈希，旧格式题目按变量值哈希"""
+    if problem_data.get('seed') is not None:
+        member = f"{problem_data['revision']}:{problem_data['seed']}"
+    else:
+        member = json.dumps(problem_data.get('var_values'), sort_keys=True)
+    digest = hashlib.sha1(member.encode('utf-8')).digest()
+    return [int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % SEEN_FILTER_BITS for i in range(SEEN_FILTER_HASHES)]
+
+
+def has_seen_variant(user_id, problem_data):
+    """学生是否（可能）见过该变体；Redis 异常时按未见过处理"""
+    pipe = redis_client.pipeline(transaction=False)
+    for offset in get_seen_filter_offsets(problem_data):
+        pipe.getbit(get_seen_filter_key(user_id, problem_data['template_id']), offset)
+    try:
+        return all(pipe.execute())
+    except redis.RedisError as e:
+        logger.warning("读取学生 %s 已见变体失败: %s", user_id, e)
+        return False
+
+
+def mark_variant_seen(user_id, problem_data):
+    key = get_seen_filter_key(user_id, problem_data['template_id'])
+    pipe = redis_client.pipeline(transaction=False)
+    for offset in get_seen_filter_offsets(problem_data):
+        pipe.setbit(key, offset, 1)
+    pipe.expire(key, SEEN_FILTER_TTL_SECONDS)
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("记录学生 %s 已见变体失败: %s", user_id, e)
+
+
+def take_problem_candidate(template_id, compiled):
+    """按来源优先级取一道候选题目：离线变体库、网格模式的合格组合表、题目池，最后在时间预算内生成。
+
+    返回 (题目数据, token)：取自题目池时 token 已由出池脚本写入 Redis，其余来源为 None。
+    """
+    problem_data = fetch_problem_from_bank(compiled)
+    if not problem_data and compiled and get_ready_variant_grid(compiled) is not None:
+        problem_data = pick_grid_problems(compiled, 1)[0]
+    if problem_data:
+        return problem_data, None
+
+    # 本进程尚未编译时由模板行计算当前修订号（不编译公式），出池脚本据此丢弃旧修订题目
+    revision = get_current_revision(template_id, compiled)
     token = uuid.uuid4().hex
-    cache_problem_with_token(token, problem_data)
+    raw_problem, pool_size, target = pop_pooled_problem_with_token(template_id, token, revision)
+    ensure_problem_pool(template_id, pool_size, target)
+    problem_data = load_problem_payload(raw_problem) if raw_problem else None
+    if problem_data and problem_data.get('revision') == revision:
+        return problem_data, token
+    if raw_problem:
+        redis_client.delete(get_problem_key(token))
+
+    # 池为空、条目无法解析或来自旧修订时，在时间预算内等待进程池生成
+    return take_generated_problem(template_id, revision), None
+
+
+def issue_problem_token(problem_data, user_id=None, token=None):
+    """为题目签发 token；传入的 token 已由出池脚本写入 Redis 时不再重复写入"""
+    if token:
+        remember_variant(problem_data)
+    else:
+        token = uuid.uuid4().hex
+        cache_problem_with_token(token, problem_data)
+    if user_id:
+        mark_variant_seen(user_id, problem_data)
     return token, problem_data
 
 
-def generate_and_cache_problem(template_id):
-    """直接生成题目并写入Redis，作为池为空时的兜底"""
-    problem_data = generate_problem_from_template(template_id)
+def fetch_problem_from_pool(template_id, user_id=None):
+    """获取题目：静态模板直接返回缓存的题目；其余优先使用离线变体库或网格模式的合格组合表，
+    其次从池中获取，如果不足则补充。
+
+    指定 user_id 时跳过该学生已见过的变体（最多 SEEN_MAX_SKIPS 次，仍然见过时照常出题）。
+    本进程尚未编译该模板时不在请求线程中编译（已提交到进程池），这次只从题目池或进程池生成的结果中取题。
+    """
+    compiled = get_compiled_template(template_id, wait=False)
+    if compiled and compiled['template_kind'] == 'static':
+        return f"{STATIC_TOKEN_PREFIX}{template_id}:{compiled['revision']}", get_static_problem(compiled)
+
+    problem_data = token = None
+    for _ in range(SEEN_MAX_SKIPS + 1):
+        candidate, candidate_token = take_problem_candidate(template_id, compiled)
+        if not candidate:
+            break
+        problem_data, token = candidate, candidate_token
+        if not user_id or not has_seen_variant(user_id, candidate):
+            break
+        if candidate_token:
+            # 该学生见过，但其他学生仍可使用：放回池的另一端，并作废出池时写入的 token
+            pipe = redis_client.pipeline(transaction=False)
+            push_pooled_problems(template_id, [candidate], client=pipe)
+            pipe.delete(get_problem_key(candidate_token))
+            pipe.execute()
+            token = None
+
     if not problem_data:
         return None, None
-    token = uuid.uuid4().hex
-    cache_problem_with_token(token, problem_data)
-    return token, problem_data
+    return issue_problem_token(problem_data, user_id, token)
+
+
+def generate_and_cache_problem(template_id, user_id=None):
+    """生成题目并写入Redis，作为池为空时的兜底（同样受时间预算与熔断限制）"""
+    problem_data = take_generated_problem(template_id)
+    if not problem_data:
+        return None, None
+    return issue_problem_token(problem_data, user_id)
+
+
+def _prewarm_template(template_id, count):
+    compiled = get_compiled_template(template_id)
+    if compiled and compiled['template_kind'] == 'static':
+        return None
+    if compiled and get_variant_grid(compiled) is not None:
+        mark_grid_template(template_id)
+        return None
+    return generate_problems_batch(template_id, count)
+
+
+def _prewarm_template_in_worker(template, count):
+    """预热子进程中执行：编译模板并生成题目（编译与生成共用硬性时间上限）；静态与网格模式的模板无需题目池，返回 None"""
+    TEMPLATE_CACHE[template['id']] = template
+    return run_with_hard_limit(GENERATION_HARD_LIMIT_SECONDS, _prewarm_template, template['id'], count)
+
+
+def update_prewarm_status(mapping=None, increment=None, pipe=None):
+    """更新预热进度（Redis 哈希）并为预热锁续期，与 pipe 中已排队的命令在同一次往返中执行，返回各命令结果"""
+    pipe = pipe or redis_client.pipeline()
+    if mapping:
+        pipe.hset(PREWARM_STATUS_KEY, mapping=mapping)
+    if increment:
+        pipe.hincrby(PREWARM_STATUS_KEY, increment, 1)
+    pipe.expire(PREWARM_STATUS_KEY, PREWARM_STATUS_TTL_SECONDS)
+    RENEW_LOCK_SCRIPT(keys=[PREWARM_LOCK_KEY], args=[INSTANCE_ID, PREWARM_LOCK_TTL_SECONDS], client=pipe)
+    return pipe.execute()
 
 
 def prewarm_pools():
-    print("[PREWARM] 开始预热题目池")
-    conn = get_db_connection()
-    if not conn:
-        print("[PREWARM] 数据库连接失败，跳过预热")
-        return
+    """启动预热：只有取得 Redis 预热锁的实例执行，各模板在独立进程池中并行补满题目池。
+
+    返回本实例是否执行了预热。
+    """
+    if not redis_client.set(PREWARM_LOCK_KEY, INSTANCE_ID, nx=True, ex=PREWARM_LOCK_TTL_SECONDS):
+        print(f"[PREWARM] 实例 {redis_client.get(PREWARM_LOCK_KEY)} 正在预热，跳过")
+        return False
+
+    print(f"[PREWARM] 开始预热题目池（实例 {INSTANCE_ID}）")
+    started = time.time()
+    try:
+        redis_client.delete(PREWARM_STATUS_KEY)
+        update_prewarm_status({'state': 'running', 'leader': INSTANCE_ID,
+                               'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                               'total': 0, 'done': 0, 'skipped': 0, 'failed': 0})
+        conn = get_db_connection()
+        if not conn:
+            print("[PREWARM] 数据库连接失败，跳过预热")
+            update_prewarm_status({'state': 'failed', 'error': '数据库连接失败'})
+            return True
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM problem_templates")
+        templates = cursor.fetchall()
+        cursor.close()
+        conn.close()
+
+        pipe = redis_client.pipeline()
+        for template in templates:
+            pipe.llen(get_pool_key(template['id']))
+            pipe.exists(get_pool_grid_key(template['id']))
+        targets, results = get_pool_targets([template['id'] for template in templates], pipe)
+        tasks = []
+        for template, pool_size, grid_mode, target in zip(templates, results[::2], results[1::2], targets):
+            # 预热时目标容量不低于 POOL_TARGET，应对开考时的集中出题
+            target = max(target, POOL_TARGET)
+            if grid_mode:
+                print(f"[PREWARM] 模板 {template['id']} 使用网格模式，无需题目池")
+            elif pool_size < target:
+                tasks.append((template, target - pool_size))
+            else:
+                print(f"[PREWARM] 模板 {template['id']} 池已满足，当前 {pool_size}")
+        update_prewarm_status({'total': len(tasks)})
+
+        if tasks:
+            workers = min(PREWARM_WORKERS, len(tasks))
+            print(f"[PREWARM] {len(tasks)} 个模板需要补货，使用 {workers} 个进程")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(_prewarm_template_in_worker, template, count): template['id']
+                           for template, count in tasks}
+                for future in as_completed(futures):
+                    template_id = futures[future]
+                    try:
+                        problems = future.result()
+                    except Exception as e:
+                        logger.error("[PREWARM] 模板 %s 预热失败: %s", template_id, e)
+                        problems = []
+                    if problems is None:
+                        print(f"[PREWARM] 模板 {template_id} 为静态题目或网格模式，无需题目池")
+                        update_prewarm_status(increment='skipped')
+                    elif problems:
+                        pipe = redis_client.pipeline()
+                        push_pooled_problems(template_id, problems, client=pipe)
+                        pushed = update_prewarm_status(increment='done', pipe=pipe)[0]
+                        print(f"[PREWARM] 模板 {template_id} 补货 {pushed} 道")
+                    else:
+                        print(f"[PREWARM] 模板 {template_id} 生成失败")
+                        update_prewarm_status(increment='failed')
+
+        update_prewarm_status({'state': 'done', 'finished_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+        print(f"[PREWARM] 预热完成，耗时 {time.time() - started:.1f}s")
+        return True
+    except Exception as e:
+        logger.error("[PREWARM] 预热失败: %s", e)
+        update_prewarm_status({'state': 'failed', 'error': str(e)})
+        return True
+    finally:
+        RELEASE_LOCK_SCRIPT(keys=[PREWARM_LOCK_KEY], args=[INSTANCE_ID])
 
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT id FROM problem_templates")
-    template_ids = [row['id'] for row in cursor.fetchall()]
-    cursor.close()
-    conn.close()
 
-    for template_id in template_ids:
-        pool_size = redis_client.llen(get_pool_key(template_id))
-        if pool_size < POOL_TARGET:
-            to_add = POOL_TARGET - pool_size
-            print(f"[PREWARM] 模板 {template_id} 补货 {to_add} 道")
-            refill_problem_pool(template_id, to_add)
-        else:
-            print(f"[PREWARM] 模板 {template_id} 池已满足，当前 {pool_size}")
-    print("[PREWARM] 预热完成")
+def get_prewarm_status():
+    """读取预热进度，未执行过预热时返回空字典"""
+    status = redis_client.hgetall(PREWARM_STATUS_KEY)
+    for field in ('total', 'done', 'skipped', 'failed'):
+        if field in status:
+            status[field] = int(status[field])
+    return status
 
 
 # 登录装饰器
@@ -746,201 +1879,1344 @@ def get_total_problem_count(paper_id=None):
         conn.close()
 
 
-def generate_problem_from_template(template_id, max_attempts=10):
-    """从模板生成具体问题 - 完全动态的合理性验证（无学习表），包含答案单位处理"""
+# 公式编译：模板公式只解析一次，按白名单转换为 sympy 表达式树，再编译为 float64/NumPy 函数
+FORMULA_BINARY_OPS = {
+    ast.Add: lambda left, right: left + right,
+    ast.Sub: lambda left, right: left - right,
+    ast.Mult: lambda left, right: left * right,
+    ast.Div: lambda left, right: left / right,
+    ast.Pow: lambda left, right: left ** right,
+    ast.Mod: lambda left, right: sp.Mod(left, right),
+}
+FORMULA_UNARY_OPS = {
+    ast.UAdd: lambda operand: operand,
+    ast.USub: lambda operand: -operand,
+}
+def _formula_round(value, ndigits=0):
+    """与旧版 eval 的内置 round 对应（四舍五入，整列求值时为 numpy.floor）"""
+    scale = sp.Integer(10) ** ndigits
+    return sp.floor(value * scale + sp.Rational(1, 2)) / scale
+
+
+def _formula_pow(base, exponent):
+    if isinstance(exponent, sp.Number) and abs(exponent) > MAX_FORMULA_EXPONENT:
+        raise ValueError(f"公式中的指数过大: {exponent}")
+    return base ** exponent
+
+
+FORMULA_FUNCTIONS = {
+    'sqrt': sp.sqrt, 'exp': sp.exp, 'log': sp.log, 'sin': sp.sin, 'cos': sp.cos, 'tan': sp.tan,
+    'asin': sp.asin, 'acos': sp.acos, 'atan': sp.atan, 'abs': sp.Abs, 'Abs': sp.Abs,
+    'min': sp.Min, 'max': sp.Max, 'integrate': sp.integrate,
+    # 旧版 eval 可用的内置函数，已有模板可能用到
+    'round': _formula_round, 'pow': _formula_pow, 'float': lambda value: value,
+}
+FORMULA_CONSTANTS = {'pi': sp.pi, 'E': sp.E}
+# 积分等符号运算使用的自由符号（与旧版 local_vars 保持一致）
+FORMULA_SYMBOLS = {name: sp.Symbol(name) for name in ('x', 't', 'h')}
+# 需要符号运算、无法直接编译为数值函数的调用
+SYMBOLIC_FUNCTIONS = {'integrate'}
+MAX_FORMULA_EXPONENT = 100
+
+
+def get_current_revision(template_id, compiled=None):
+    """模板当前修订号：优先取已编译结果，否则由模板行计算（不编译公式）；模板不存在时返回 None"""
+    if compiled:
+        return compiled['revision']
     template = get_template(template_id)
+    return get_template_revision(template) if template else None
+
+
+def get_template_revision(template):
+    """模板修订号：由影响出题结果的字段及 revision 列计算短摘要，字段变化或编辑保存即视为新修订。"""
+    digest = hashlib.sha1()
+    for field in ('problem_text', 'variables', 'solution_formula', 'answer_count', 'answer_units'):
+        digest.update(str(template.get(field) or '').encode('utf-8'))
+        digest.update(b'\x1f')
+    # 答案约束只在配置时参与计算，未配置的模板修订号保持不变
+    if template.get('answer_constraints'):
+        digest.update(str(template['answer_constraints']).encode('utf-8'))
+    # revision 列从 1 开始，未编辑过的模板修订号与增加该列之前一致
+    if (template.get('revision') or 1) > 1:
+        digest.update(f"\x1frevision:{template['revision']}".encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def _formula_function_name(func_node):
+    """解析调用目标，只允许 `sqrt(...)` 或 `sp.sqrt(...)` 形式的白名单函数。"""
+    if isinstance(func_node, ast.Name):
+        return func_node.id
+    if (isinstance(func_node, ast.Attribute) and isinstance(func_node.value, ast.Name)
+            and func_node.value.id == 'sp'):
+        return func_node.attr
+    return None
 
-    if not template:
-        return None
 
-    variables, configured_ranges = parse_variable_specs(template.get('variables', ''))
+def validate_formula_tree(tree, variables):
+    """按白名单检查公式语法树，不合法时抛出 ValueError。
 
-    # 符号定义
-    x, t, h = sp.symbols('x t h')
-    local_vars = {
-        'x': x, 't': t, 'h': h, 'sp': sp, 'sqrt': sp.sqrt, 'exp': sp.exp,
-        'integrate': sp.integrate, 'pi': pi, 'log': log, 'sin': sp.sin, 'cos': sp.cos
+    函数名只能出现在调用位置，`sp` 只能作为属性访问的前缀（如 `sqrt`、`sp` 单独作为值时不合法）。
+    """
+    allowed_names = set(variables) | set(FORMULA_CONSTANTS) | set(FORMULA_SYMBOLS)
+    callees = set()
+    attribute_bases = set()
+    # ast.walk 按层遍历，父节点先于子节点访问
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            callees.add(id(node.func))
+        elif isinstance(node, ast.Attribute):
+            attribute_bases.add(id(node.value))
+        if isinstance(node, (ast.Expression, ast.Tuple, ast.expr_context, ast.operator, ast.unaryop)):
+            continue
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise ValueError(f"公式中不允许的常量: {node.value!r}")
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in FORMULA_BINARY_OPS:
+                raise ValueError(f"公式中不允许的运算: {type(node.op).__name__}")
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in FORMULA_UNARY_OPS:
+                raise ValueError(f"公式中不允许的运算: {type(node.op).__name__}")
+        elif isinstance(node, ast.Call):
+            name = _formula_function_name(node.func)
+            if name not in FORMULA_FUNCTIONS or node.keywords:
+                raise ValueError(f"公式中不允许的函数调用: {ast.unparse(node.func)}")
+        elif isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id == 'sp'
+                    and (node.attr in FORMULA_CONSTANTS
+                         or (node.attr in FORMULA_FUNCTIONS and id(node) in callees))):
+                raise ValueError(f"公式中不允许的属性访问: {ast.unparse(node)}")
+        elif isinstance(node, ast.Name):
+            if node.id == 'sp' and id(node) in attribute_bases:
+                continue
+            if node.id in allowed_names:
+                continue
+            if node.id in FORMULA_FUNCTIONS and id(node) in callees:
+                continue
+            raise ValueError(f"公式中存在未定义的名称: {node.id}")
+        else:
+            raise ValueError(f"公式中不允许的语法: {type(node).__name__}")
+
+
+def build_formula_expr(node, env):
+    """把已通过白名单检查的语法树节点转换为 sympy 表达式，env 为变量名到符号或数值的映射。"""
+    if isinstance(node, ast.Expression):
+        return build_formula_expr(node.body, env)
+    if isinstance(node, ast.Tuple):
+        return tuple(build_formula_expr(elt, env) for elt in node.elts)
+    if isinstance(node, ast.Constant):
+        return sp.Integer(node.value) if isinstance(node.value, int) else sp.Float(node.value)
+    if isinstance(node, ast.Name):
+        if node.id in env:
+            return env[node.id]
+        if node.id in FORMULA_CONSTANTS:
+            return FORMULA_CONSTANTS[node.id]
+        return FORMULA_SYMBOLS[node.id]
+    if isinstance(node, ast.Attribute):
+        return FORMULA_CONSTANTS[node.attr]
+    if isinstance(node, ast.BinOp):
+        left = build_formula_expr(node.left, env)
+        right = build_formula_expr(node.right, env)
+        if isinstance(node.op, ast.Pow) and isinstance(right, sp.Number) and abs(right) > MAX_FORMULA_EXPONENT:
+            raise ValueError(f"公式中的指数过大: {right}")
+        return FORMULA_BINARY_OPS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp):
+        return FORMULA_UNARY_OPS[type(node.op)](build_formula_expr(node.operand, env))
+    if isinstance(node, ast.Call):
+        func = FORMULA_FUNCTIONS[_formula_function_name(node.func)]
+        return func(*[build_formula_expr(arg, env) for arg in node.args])
+    raise ValueError(f"公式中不允许的语法: {type(node).__name__}")
+
+
+def _formula_uses_symbolic_calls(tree):
+    return any(
+        isinstance(node, ast.Call) and _formula_function_name(node.func) in SYMBOLIC_FUNCTIONS
+        for node in ast.walk(tree)
+    )
+
+
+def compile_variable_expression(text, variables):
+    """编译变量定义中的表达式（上下限或派生公式），返回 sympy 表达式及其整列求值函数"""
+    tree = ast.parse(text, mode='eval')
+    validate_formula_tree(tree, variables)
+    if _formula_uses_symbolic_calls(tree) or isinstance(tree.body, ast.Tuple):
+        raise ValueError(f"变量表达式只支持数值运算: {text}")
+    expr = sp.sympify(build_formula_expr(tree, {var: sp.Symbol(var) for var in variables}))
+    args = sorted(str(symbol) for symbol in expr.free_symbols)
+    stray = set(args) - set(variables)
+    if stray:
+        raise ValueError(f"变量表达式中存在未定义的变量: {', '.join(sorted(stray))}")
+    return {
+        'expr': expr,
+        'args': args,
+        'func': sp.lambdify([sp.Symbol(arg) for arg in args], expr, modules='numpy'),
     }
 
-    # 内存中的自适应范围（不持久化）
-    reasonable_ranges = {}
-    for var in variables:
-        reasonable_ranges[var] = configured_ranges.get(var, get_adaptive_default_range(var))
 
-    answer_units = parse_answer_units(template)
-    answer_constraints = infer_answer_constraints(answer_units)
+def evaluate_variable_expression(rule, columns, size):
+    """对整列变量值求变量表达式"""
+    return _to_answer_column(rule['func'](*[columns[arg] for arg in rule['args']]), size)
+
+
+def compile_variable_rules(variables, specs):
+    """编译变量间的约束，返回 (rules, order)：rules 为变量 -> {lower, upper, derived}，
+    order 为满足依赖关系的采样顺序（同层保持定义顺序）。"""
+    rules = {}
+    for var, spec in specs.items():
+        rule = {}
+        for key in ('lower', 'upper', 'derived'):
+            value = spec.get(key)
+            if isinstance(value, str):
+                rule[key] = compile_variable_expression(value, variables)
+            elif value is not None:
+                rule[key] = float(value)
+        if any(isinstance(value, dict) for value in rule.values()) or 'derived' in rule:
+            rules[var] = rule
+
+    dependencies = {
+        var: {arg for value in rules.get(var, {}).values() if isinstance(value, dict) for arg in value['args']}
+        for var in variables
+    }
+    order = []
+    pending = list(variables)
+    while pending:
+        ready = [var for var in pending if dependencies[var] <= set(order)]
+        if not ready:
+            raise ValueError(f"变量约束存在循环依赖: {', '.join(pending)}")
+        order.extend(ready)
+        pending = [var for var in pending if var not in ready]
+    return rules, order
+
+
+def get_rule_envelope(rule_value, ranges):
+    """求约束上下限（数值或表达式）在依赖变量范围上的取值区间"""
+    if not isinstance(rule_value, dict):
+        return rule_value, rule_value
+    return interval_bounds(rule_value['expr'], {sp.Symbol(arg): ranges[arg] for arg in rule_value['args']})
+
+
+def propagate_variable_ranges(compiled, ranges):
+    """按依赖顺序推算带约束变量与派生变量的取值范围（区间分析，失败时保留原范围）"""
+    ranges = dict(ranges)
+    for var in compiled['variable_order']:
+        rule = compiled['variable_rules'].get(var)
+        if not rule:
+            continue
+        if 'derived' in rule:
+            envelope = get_rule_envelope(rule['derived'], ranges)
+            if envelope:
+                ranges[var] = envelope
+            continue
+        min_val, max_val = ranges[var]
+        lower = get_rule_envelope(rule['lower'], ranges)
+        upper = get_rule_envelope(rule['upper'], ranges)
+        if lower and upper and lower[0] <= upper[1]:
+            ranges[var] = (lower[0], upper[1])
+    return ranges
+
+
+def _vectorize_special_function(func):
+    """把 mpmath 特殊函数包装为逐元素的 float64 函数，复数结果记为 NaN"""
+    def scalar(*args):
+        value = func(*args)
+        if isinstance(value, mpmath.mpc):
+            return float(value.real) if value.imag == 0 else math.nan
+        return float(value)
+    return np.vectorize(scalar, otypes=[np.float64])
+
+
+# 闭式解中常见、但 NumPy 没有对应实现的特殊函数（lambdify 默认回退到 math 模块或未定义的名称）
+NUMERIC_SPECIAL_FUNCTIONS = {
+    name: _vectorize_special_function(func) for name, func in (
+        ('erf', mpmath.erf), ('erfc', mpmath.erfc), ('erfi', mpmath.erfi),
+        ('Si', mpmath.si), ('Ci', mpmath.ci), ('Shi', mpmath.shi), ('Chi', mpmath.chi),
+        ('Ei', mpmath.ei), ('li', mpmath.li), ('fresnels', mpmath.fresnels), ('fresnelc', mpmath.fresnelc),
+        ('gamma', mpmath.gamma), ('loggamma', mpmath.loggamma),
+    )
+}
 
-    for attempt in range(max_attempts):
-        var_values = {}
 
-        # 使用自适应范围生成变量
-        for var in variables:
-            min_val, max_val = reasonable_ranges[var]
-            # 随着尝试次数增加，逐渐扩大搜索范围
-            range_expansion = 1.0 + (attempt * 0.1)  # 每次尝试扩大10%
-            expanded_min = max(0.01, min_val / range_expansion)
-            expanded_max = max_val * range_expansion
+def build_formula_evaluator(variables, expressions):
+    """把全部答案表达式编译为一个融合的数值函数：先对所有答案做公共子表达式消除（sympy cse），
+    一次遍历变量列即可求出全部答案。"""
+    return sp.lambdify([sp.Symbol(var) for var in variables], expressions,
+                       modules=[NUMERIC_SPECIAL_FUNCTIONS, 'numpy'], cse=True)
 
-            var_values[var] = round(random.uniform(expanded_min, expanded_max), 2)
 
-        # 格式化问题文本
-        problem_content = format_problem_text(template['problem_text'], var_values)
+def find_constant_answers(tree, variables, answer_count):
+    """找出不依赖任何变量的公式结果，返回 (按结果位置的常量, 按答案位置的常量)。
 
-        # 计算答案
+    答案个数与公式结果个数不一致时沿用求值规则：所有答案取第一个结果。
+    """
+    nodes = list(tree.body.elts) if isinstance(tree.body, ast.Tuple) else [tree.body]
+    node_constants = {}
+    for index, node in enumerate(nodes):
+        names = {child.id for child in ast.walk(node) if isinstance(child, ast.Name)}
+        if names & set(variables) or _formula_uses_symbolic_calls(node):
+            continue
         try:
-            current_vars = local_vars.copy()
-            current_vars.update(var_values)
+            value = float(sp.sympify(build_formula_expr(node, {})).evalf())
+        except (TypeError, ValueError, ZeroDivisionError, ArithmeticError):
+            continue
+        if math.isfinite(value):
+            node_constants[index] = value
 
-            correct_answer = eval(template['solution_formula'], {}, current_vars)
+    if len(nodes) == answer_count:
+        return node_constants, dict(node_constants)
+    if 0 in node_constants:
+        return node_constants, {index: node_constants[0] for index in range(answer_count)}
+    return node_constants, {}
 
-            if isinstance(correct_answer, tuple):
-                correct_answers = [float(a.evalf()) if hasattr(a, 'evalf') else float(a) for a in correct_answer]
-            else:
-                correct_answers = [
-                    float(correct_answer.evalf()) if hasattr(correct_answer, 'evalf') else float(correct_answer)]
-
-            answer_count = template.get('answer_count', 1)
-            if len(correct_answers) != answer_count:
-                correct_answers = [correct_answers[0]] * answer_count
-
-            # 动态合理性验证（标准随尝试次数放宽）
-            if is_answer_reasonable_dynamic(correct_answers, var_values, attempt, answer_constraints):
-                # 在内存中更新合理范围（仅本次运行有效）
-                for var, value in var_values.items():
-                    current_min, current_max = reasonable_ranges[var]
-                    reasonable_ranges[var] = (
-                        min(current_min, value * 0.8),  # 稍微扩大下限
-                        max(current_max, value * 1.2)  # 稍微扩大上限
-                    )
-
-                # 确保答案单位数量与答案数量匹配
-                answer_count = template.get('answer_count', 1)
-                if len(answer_units) < answer_count:
-                    # 如果单位数量不足，用空字符串补齐
-                    answer_units.extend([''] * (answer_count - len(answer_units)))
-                elif len(answer_units) > answer_count:
-                    # 如果单位数量过多，只取前answer_count个
-                    answer_units = answer_units[:answer_count]
-
-                # 格式化显示答案（保留适当小数位数）
-                formatted_correct_answers = []
-                for i, answer in enumerate(correct_answers):
-                    # 根据答案大小选择合适的小数位数
-                    abs_answer = abs(answer)
-                    if abs_answer == 0:
-                        formatted_correct_answers.append(0.0)
-                    elif abs_answer >= 1000:
-                        formatted_correct_answers.append(round(answer, 0))
-                    elif abs_answer >= 1:
-                        formatted_correct_answers.append(round(answer, 2))
-                    elif abs_answer >= 0.01:
-                        formatted_correct_answers.append(round(answer, 4))
-                    else:
-                        formatted_correct_answers.append(round(answer, 6))
-
-                # 构建最终返回数据，包含答案单位
-                result_data = {
-                    'problem_text': problem_content,
-                    'var_values': var_values,
-                    'correct_answers': formatted_correct_answers,  # 使用格式化后的答案
-                    'answer_units': answer_units,  # 添加答案单位
-                    'template_id': template_id,
-                    'answer_count': template.get('answer_count', 1),
-                    'template_name': template['template_name'],
-                    'image_filename': template.get('image_filename')
-                }
-
-                # 调试信息
-                print(f"✅ 题目生成成功 - 模板: {template['template_name']}")
-                print(f"   变量值: {var_values}")
-                print(f"   正确答案: {formatted_correct_answers}")
-                print(f"   答案单位: {answer_units}")
-                print(f"   答案数量: {answer_count}")
-
-                return result_data
 
-        except Exception as e:
-            # 计算失败，继续尝试
-            print(f"⚠️ 题目生成尝试 {attempt + 1} 失败: {str(e)}")
-            continue
+def compile_template(template, feasible_ranges=None):
+    """编译模板：解析变量范围、答案约束与公式，生成可整列求值的数值函数。
+
+    feasible_ranges 为已在子进程中推算好的采样范围，传入时不再做区间分析。
+    """
+    variables, configured_ranges, variable_specs = parse_variable_specs(template.get('variables', ''))
+    variable_rules, variable_order = compile_variable_rules(variables, variable_specs)
+    sampled_variables = [var for var in variables if 'derived' not in variable_rules.get(var, {})]
+    answer_count = template.get('answer_count', 1) or 1
+
+    answer_units = parse_answer_units(template)
+    if len(answer_units) < answer_count:
+        answer_units.extend([''] * (answer_count - len(answer_units)))
+    elif len(answer_units) > answer_count:
+        answer_units = answer_units[:answer_count]
 
-    # 最终回退：使用保守但保证成功的方法
-    return generate_fallback_problem(template, variables, local_vars, reasonable_ranges, answer_units, answer_constraints)
+    formula = (template.get('solution_formula') or '').strip()
+    tree = ast.parse(formula, mode='eval')
+    validate_formula_tree(tree, variables)
 
+    text_literals, text_slots = split_problem_text(template.get('problem_text', ''), set(variables))
 
-def generate_fallback_problem(template, variables, local_vars, reasonable_ranges=None, answer_units=None, answer_constraints=None):
-    """最终回退方案：使用保守范围生成题目"""
-    answer_units = answer_units or parse_answer_units(template)
-    answer_constraints = answer_constraints or infer_answer_constraints(answer_units)
+    # 模板分类：static 没有采样变量（只有一道题）；partial 部分答案为常量；dynamic 答案全部依赖变量
+    node_constants, constant_answers = find_constant_answers(tree, variables, answer_count)
+    if not sampled_variables:
+        template_kind = 'static'
+    elif constant_answers:
+        template_kind = 'partial'
+    else:
+        template_kind = 'dynamic'
+
+    ranges = {var: configured_ranges.get(var, get_adaptive_default_range(var)) for var in variables}
+    var_decimals = {var: spec['decimals'] for var, spec in variable_specs.items() if 'decimals' in spec}
+
+    symbols = {var: sp.Symbol(var) for var in variables}
+    expressions = None
+    evaluator = None
+    if not _formula_uses_symbolic_calls(tree):
+        result = build_formula_expr(tree, symbols)
+        expressions = [sp.sympify(expr) for expr in (result if isinstance(result, tuple) else (result,))]
+        stray_symbols = set().union(*(expr.free_symbols for expr in expressions)) - set(symbols.values())
+        if stray_symbols:
+            raise ValueError(f"公式中存在未赋值的符号: {', '.join(sorted(map(str, stray_symbols)))}")
+        evaluator = build_formula_evaluator(variables, expressions)
+
+    compiled = {
+        'template_id': template['id'],
+        'revision': get_template_revision(template),
+        'template': template,
+        'variables': variables,
+        'sampled_variables': sampled_variables,
+        'variable_rules': variable_rules,
+        'variable_order': variable_order,
+        'configured_ranges': ranges,
+        'ranges': ranges,
+        'answer_count': answer_count,
+        'answer_units': answer_units,
+        'answer_constraints': merge_answer_constraints(infer_answer_constraints(answer_units), template),
+        'text_literals': text_literals,
+        'text_slots': text_slots,
+        'var_decimals': var_decimals,
+        'formula_tree': tree,
+        'answer_nodes': list(tree.body.elts) if isinstance(tree.body, ast.Tuple) else [tree.body],
+        'expressions': expressions,
+        'evaluator': evaluator,
+        'template_kind': template_kind,
+        'sampler': VARIANT_SAMPLER,
+        'constant_nodes': node_constants,
+        'constant_answers': constant_answers,
+        'dynamic_answer_slots': [index for index in range(answer_count) if index not in constant_answers],
+    }
+    if variable_rules:
+        compiled['configured_ranges'] = compiled['ranges'] = propagate_variable_ranges(compiled, ranges)
+    compiled['lattice'] = build_variable_lattice(sampled_variables, compiled['ranges'], variable_specs)
+
+    if evaluator is None and template_kind != 'static':
+        attach_closed_form(compiled)
+        evaluator = compiled['evaluator']
+
+    # 编译期用区间分析收缩采样范围，使首轮采样几乎都能通过校验
+    if feasible_ranges is not None:
+        compiled['ranges'] = feasible_ranges
+    elif evaluator is not None and template_kind != 'static' and compiled['dynamic_answer_slots']:
+        compiled['ranges'] = derive_feasible_ranges(compiled)
+    return compiled
+
+
+def solve_closed_form(compiled):
+    """以变量为符号求解公式中的积分等符号运算，返回闭式表达式列表；求不出闭式解时返回 None"""
+    variables = compiled['variables']
+    # 采样变量恒为正，给出假设便于积分化简；派生变量只假设为实数
+    symbols = {
+        var: sp.Symbol(var, positive=True) if var in compiled['sampled_variables'] else sp.Symbol(var, real=True)
+        for var in variables
+    }
+    try:
+        result = build_formula_expr(compiled['formula_tree'], symbols)
+        expressions = [sp.sympify(expr) for expr in (result if isinstance(result, tuple) else (result,))]
+    except (TypeError, ValueError, ZeroDivisionError, ArithmeticError, NotImplementedError) as e:
+        logger.info("模板 %s 无法求出闭式解: %s", compiled['template_id'], e)
+        return None
+    if any(expr.has(sp.Integral) for expr in expressions):
+        return None
+    if set().union(*(expr.free_symbols for expr in expressions)) - set(symbols.values()):
+        return None
 
-    correct_answers = [0.0] * template.get('answer_count', 1)
-    problem_content = template['problem_text']
+    # 换回不带假设的符号，与数值求值函数的参数一致
+    plain_symbols = {symbols[var]: sp.Symbol(var) for var in variables}
+    return [expr.xreplace(plain_symbols) for expr in expressions]
+
+
+def closed_form_matches(compiled, evaluator):
+    """抽样对比闭式解与逐行符号求值的结果；闭式解求值出错（如含无法数值化的特殊函数）视为不一致"""
+    rng = np.random.default_rng(0)
+    columns = sample_variable_matrix(compiled, compiled['ranges'], 0, CLOSED_FORM_CHECK_ROWS, rng)
+    expected = evaluate_compiled_formula(compiled, columns, CLOSED_FORM_CHECK_ROWS)
+    try:
+        actual = evaluate_compiled_formula(dict(compiled, evaluator=evaluator), columns, CLOSED_FORM_CHECK_ROWS)
+    except Exception as e:
+        logger.warning("模板 %s 闭式解无法数值求值: %s", compiled['template_id'], e)
+        return False
+    return bool(np.allclose(actual, expected, rtol=1e-6, atol=1e-9, equal_nan=True))
 
-    for attempt in range(5):
-        var_values = {}
-        for var in variables:
-            min_val, max_val = (reasonable_ranges or {}).get(var, (1.0, 3.0))
-            var_values[var] = round(random.uniform(min_val, max_val), 2)
 
-        problem_content = format_problem_text(template['problem_text'], var_values)
+# 闭式解缓存的序列化：表达式树存为嵌套 JSON，读取时只按名称查找 sympy 类重建，不经过 sympify/eval
+CLOSED_FORM_SINGLETONS = {
+    type(value).__name__: value for value in (
+        sp.pi, sp.E, sp.I, sp.oo, -sp.oo, sp.zoo, sp.nan, sp.EulerGamma, sp.Catalan, sp.GoldenRatio,
+        sp.true, sp.false,
+    )
+}
+CLOSED_FORM_EXTRA_CLASSES = {'ExprCondPair': ExprCondPair}  # Piecewise 的分支，不在 sympy 顶层命名空间
+
+
+def dump_closed_form_expr(expr):
+    """把 sympy 表达式转换为可 JSON 序列化的嵌套列表"""
+    if isinstance(expr, sp.Symbol):
+        return ['S', expr.name]
+    if isinstance(expr, sp.Integer):
+        return ['I', str(expr.p)]
+    if isinstance(expr, sp.Rational):
+        return ['Q', str(expr.p), str(expr.q)]
+    if isinstance(expr, sp.Float):
+        return ['F', repr(float(expr))]
+    if type(expr).__name__ in CLOSED_FORM_SINGLETONS:
+        return ['C', type(expr).__name__]
+    if not expr.args:
+        raise ValueError(f"闭式解中无法序列化的原子: {expr!r}")
+    return ['f', type(expr).__name__, [dump_closed_form_expr(arg) for arg in expr.args]]
+
+
+def load_closed_form_expr(data):
+    """由 dump_closed_form_expr 的结果重建表达式；只接受 sympy 中的表达式类，格式不符时抛出 ValueError"""
+    if not isinstance(data, list) or not data:
+        raise ValueError(f"闭式解缓存格式不正确: {data!r}")
+    kind = data[0]
+    if kind == 'S' and len(data) == 2:
+        return sp.Symbol(str(data[1]))
+    if kind == 'I' and len(data) == 2:
+        return sp.Integer(int(data[1]))
+    if kind == 'Q' and len(data) == 3:
+        return sp.Rational(int(data[1]), int(data[2]))
+    if kind == 'F' and len(data) == 2:
+        return sp.Float(float(data[1]))
+    if kind == 'C' and len(data) == 2 and data[1] in CLOSED_FORM_SINGLETONS:
+        return CLOSED_FORM_SINGLETONS[data[1]]
+    if kind == 'f' and len(data) == 3 and isinstance(data[1], str) and isinstance(data[2], list):
+        cls = CLOSED_FORM_EXTRA_CLASSES.get(data[1]) or getattr(sp, data[1], None)
+        if isinstance(cls, type) and issubclass(cls, sp.Basic):
+            return cls(*[load_closed_form_expr(arg) for arg in data[2]])
+    raise ValueError(f"闭式解缓存格式不正确: {data!r}")
+
+
+def attach_closed_form(compiled):
+    """为含符号运算的公式准备闭式解：优先读 Redis 缓存，否则求解、抽样验证后写入缓存。
+
+    成功时设置 compiled 的 expressions 与 evaluator，之后每个变体只需代入数值；
+    求解或验证过程中出现任何异常都记为无闭式解，继续逐行求值。
+    """
+    template_id = compiled['template_id']
+    key = get_closed_form_key(template_id, compiled['revision']) if template_id is not None else None
+    try:
+        cached = redis_client.get(key) if key else None
+    except redis.RedisError as e:
+        logger.warning("读取模板 %s 闭式解缓存失败: %s", template_id, e)
+        cached = None
 
+    expressions = evaluator = None
+    if cached is not None:
         try:
-            current_vars = local_vars.copy()
-            current_vars.update(var_values)
-            correct_answer = eval(template['solution_formula'], {}, current_vars)
+            stored = json.loads(cached)
+            if stored is None:  # 已确认无法求出闭式解
+                return
+            expressions = [load_closed_form_expr(item) for item in stored]
+            evaluator = build_formula_evaluator(compiled['variables'], expressions)
+        except Exception as e:
+            # 旧格式或损坏的缓存：重新求解并覆盖
+            logger.warning("模板 %s 闭式解缓存无法读取，重新求解: %s", template_id, e)
+            cached = None
 
-            if isinstance(correct_answer, tuple):
-                current_answers = [float(a.evalf()) if hasattr(a, 'evalf') else float(a) for a in correct_answer]
-            else:
-                current_answers = [
-                    float(correct_answer.evalf()) if hasattr(correct_answer, 'evalf') else float(correct_answer)]
+    if cached is None:
+        started = time.time()
+        try:
+            expressions = solve_closed_form(compiled)
+            evaluator = build_formula_evaluator(compiled['variables'], expressions) if expressions else None
+            if evaluator is not None and not closed_form_matches(compiled, evaluator):
+                logger.warning("模板 %s 闭式解与逐行求值不一致，继续逐行求值", template_id)
+                expressions = evaluator = None
+            stored = [dump_closed_form_expr(expr) for expr in expressions] if expressions else None
+        except Exception as e:
+            logger.warning("模板 %s 求解闭式解失败，继续逐行求值: %s", template_id, e)
+            expressions = evaluator = stored = None
+        if key:
+            try:
+                redis_client.setex(key, CLOSED_FORM_TTL_SECONDS, json.dumps(stored))
+            except redis.RedisError as e:
+                logger.warning("写入模板 %s 闭式解缓存失败: %s", template_id, e)
+        if expressions:
+            print(f"🧮 模板 {template_id} 已求出闭式解（{time.time() - started:.2f}s）: "
+                  f"{', '.join(map(str, expressions))}")
+
+    if expressions:
+        compiled['expressions'] = expressions
+        compiled['evaluator'] = evaluator
 
-            answer_count = template.get('answer_count', 1)
-            if len(current_answers) != answer_count:
-                current_answers = [current_answers[0]] * answer_count
 
-            if is_answer_reasonable_dynamic(current_answers, var_values, attempt, answer_constraints):
-                correct_answers = current_answers
+ANALYTIC_SHRINK_STEP = 0.2  # 每次从某个变量区间一端裁掉原宽度的比例
+ANALYTIC_SHRINK_MIN_WIDTH = 0.2  # 变量区间至少保留原宽度的比例
+ANALYTIC_SHRINK_MAX_ITERATIONS = 40
+ANALYTIC_SHRINK_SAMPLE_ROWS = 512  # 判断是否需要收缩时，在配置范围上抽样校验的行数
+ANALYTIC_SHRINK_MIN_REJECTION_RATE = 0.1  # 配置范围上的抽样拒绝率低于该值时不收缩
+
+
+def interval_bounds(expr, box):
+    """用区间算术（sympy AccumBounds）求表达式在变量盒上的取值范围，无法确定时返回 None"""
+    try:
+        result = expr.subs({
+            symbol: sp.Float(low) if low == high else sp.AccumBounds(low, high)
+            for symbol, (low, high) in box.items()
+        })
+        if isinstance(result, sp.AccumBounds):
+            low, high = float(result.min), float(result.max)
+        else:
+            low = high = float(result)
+    except Exception:  # 取模等表达式代入区间时可能抛出 RecursionError 等任意异常
+        return None
+    if math.isnan(low) or math.isnan(high):
+        return None
+    return low, high
+
+
+def analyse_answer_expressions(compiled, box):
+    """分析每个答案表达式：常量、对各变量单调（记录方向）、多项式（区间算术）或无法分析"""
+    symbols = {var: sp.Symbol(var) for var in compiled['variables']}
+    symbol_box = {symbols[var]: box[var] for var in compiled['variables']}
+    analysis = []
+    for expr in compiled['expressions']:
+        expr = expr.evalf()
+        if not expr.free_symbols:
+            analysis.append({'kind': 'constant'})
+            continue
+
+        directions = {}
+        for var in compiled['variables']:
+            if symbols[var] not in expr.free_symbols:
+                continue
+            derivative_bounds = interval_bounds(sp.diff(expr, symbols[var]), symbol_box)
+            if derivative_bounds is None or (derivative_bounds[0] < 0 < derivative_bounds[1]):
+                directions = None
                 break
-        except Exception:
+            directions[var] = 1 if derivative_bounds[0] >= 0 else -1
+
+        if directions is not None:
+            analysis.append({'kind': 'monotone', 'directions': directions})
+        elif expr.is_polynomial(*symbols.values()):
+            analysis.append({'kind': 'polynomial', 'expr': expr, 'symbols': symbols})
+        else:
+            analysis.append({'kind': 'unknown'})
+    return analysis
+
+
+def answer_bounds_on_box(compiled, analysis, box):
+    """求各答案在变量盒上的上下界：单调表达式取两个角点求值，多项式用区间算术"""
+    variables = compiled['variables']
+    corner_columns = {var: [] for var in variables}
+    monotone_indexes = []
+    for index, item in enumerate(analysis):
+        if item['kind'] != 'monotone':
+            continue
+        monotone_indexes.append(index)
+        for direction in (-1, 1):  # 先取最小值角点，再取最大值角点
+            for var in variables:
+                low, high = box[var]
+                increasing = item['directions'].get(var, 1) * direction > 0
+                corner_columns[var].append(high if increasing else low)
+
+    bounds = [None] * len(analysis)
+    if monotone_indexes:
+        size = 2 * len(monotone_indexes)
+        columns = {var: np.array(values, dtype=np.float64) for var, values in corner_columns.items()}
+        values = evaluate_compiled_formula(compiled, columns, size)
+        for position, index in enumerate(monotone_indexes):
+            low, high = values[index, 2 * position], values[index, 2 * position + 1]
+            bounds[index] = (float(min(low, high)), float(max(low, high)))
+
+    for index, item in enumerate(analysis):
+        if item['kind'] == 'polynomial':
+            symbols = item['symbols']
+            bounds[index] = interval_bounds(item['expr'], {symbols[var]: box[var] for var in variables})
+    return bounds
+
+
+def bounds_violation(bounds, constraints, box):
+    """答案上下界超出首轮校验标准的程度（0 表示整个变量盒都满足），与 answers_reasonable_mask 的阈值一致"""
+    max_answer = constraints.get('max_answer')
+    min_answer = constraints.get('min_answer')
+    upper = min(1e6, max_answer) if max_answer is not None else 1e6
+    lower = max(1e-8, min_answer) if min_answer is not None else 1e-8
+    # 答案与变量均值的比率需在 [0.001, 1000] 内，这里取变量盒上最宽松的情形
+    upper = min(upper, 1000 * float(np.mean([abs(high) for _, high in box.values()])))
+    lower = max(lower, 0.001 * float(np.mean([abs(low) for low, _ in box.values()])))
+
+    violation = 0.0
+    for item_bounds in bounds:
+        if item_bounds is None:
             continue
+        low, high = item_bounds
+        if constraints.get('non_negative') and low < 0:
+            violation += min(1.0, -low / (high - low)) if high > low else 1.0
+        magnitude_high = max(abs(low), abs(high))
+        if magnitude_high > upper:
+            violation += math.log10(magnitude_high / upper)
+        if low > 0 or high < 0:
+            magnitude_low = min(abs(low), abs(high))
+            if magnitude_low < lower:
+                violation += math.log10(lower / max(magnitude_low, 1e-300))
+    return violation
+
+
+def sampled_rejection_rate(compiled, ranges):
+    """在给定范围上按首轮标准抽样校验，返回被拒绝的比例"""
+    rng = np.random.default_rng(0)
+    columns = sample_variable_matrix(compiled, ranges, 0, ANALYTIC_SHRINK_SAMPLE_ROWS, rng)
+    answers = evaluate_compiled_formula(compiled, columns, ANALYTIC_SHRINK_SAMPLE_ROWS)
+    return 1.0 - float(answer_matrix_mask(compiled, answers, columns, 0).mean())
+
+
+def derive_feasible_ranges(compiled):
+    """配置范围上的抽样拒绝率明显时，用区间分析收缩采样范围；分析出错时保留原范围"""
+    try:
+        rejection_rate = sampled_rejection_rate(compiled, compiled['ranges'])
+        if rejection_rate < ANALYTIC_SHRINK_MIN_REJECTION_RATE:
+            return compiled['ranges']
+        return shrink_feasible_ranges(compiled)
+    except Exception as e:
+        logger.warning("模板 %s 区间分析失败，保留原采样范围: %s", compiled['template_id'], e)
+        return compiled['ranges']
+
+
+def shrink_feasible_ranges(compiled):
+    """对单调或多项式公式做区间分析，逐步裁剪变量范围直到答案上下界落入校验标准（或无法继续改善）"""
+    box = {var: (max(0.01, low), high) for var, (low, high) in compiled['ranges'].items()}
+    if any(low >= high for low, high in box.values()):
+        return compiled['ranges']
+    # 只裁剪独立变量，带约束的变量和派生变量的范围随之推算
+    free_variables = [var for var in compiled['variables'] if var not in compiled['variable_rules']]
+
+    analysis = analyse_answer_expressions(compiled, box)
+    constraints = compiled['answer_constraints']
+    violation = bounds_violation(answer_bounds_on_box(compiled, analysis, box), constraints, box)
+    if violation == 0 or not math.isfinite(violation):
+        return compiled['ranges']
+
+    widths = {var: high - low for var, (low, high) in box.items()}
+    for _ in range(ANALYTIC_SHRINK_MAX_ITERATIONS):
+        best = None
+        for var in free_variables:
+            low, high = box[var]
+            cut = widths[var] * ANALYTIC_SHRINK_STEP
+            if (high - low) - cut < widths[var] * ANALYTIC_SHRINK_MIN_WIDTH:
+                continue
+            for candidate in ((low + cut, high), (low, high - cut)):
+                trial_box = dict(box)
+                trial_box[var] = candidate
+                if compiled['variable_rules']:
+                    trial_box = propagate_variable_ranges(compiled, trial_box)
+                trial_violation = bounds_violation(
+                    answer_bounds_on_box(compiled, analysis, trial_box), constraints, trial_box)
+                if best is None or trial_violation < best[0]:
+                    best = (trial_violation, var, candidate)
+        if best is None or best[0] >= violation:
+            break
+        violation, var, candidate = best
+        box[var] = candidate
+        if compiled['variable_rules']:
+            box = propagate_variable_ranges(compiled, box)
+        if violation == 0:
+            break
+
+    logger.info("模板 %s 区间分析收缩采样范围: %s -> %s（剩余超限度 %.3f）",
+                compiled['template_id'], compiled['ranges'], box, violation)
+    return box
+
+
+def get_compiled_template(template_id, revision=None, wait=True):
+    """获取编译后的模板，按 (模板ID, 修订号) 缓存；公式非法时返回 None。
+
+    指定 revision 时只返回该修订：本进程缓存的模板较旧时从数据库刷新一次，仍不一致则返回 None。
+    wait=False 时（请求线程）未缓存的模板提交到进程池编译，立即返回 None。
+    """
+    template = get_template(template_id)
+    if not template:
+        return None
+
+    if revision is not None and get_template_revision(template) != revision:
+        if (template_id, revision) in STALE_REVISIONS:
+            return None
+        template = load_template_from_db(template_id)
+        if not template:
+            return None
+        TEMPLATE_CACHE[template_id] = template
+        if get_template_revision(template) != revision:
+            STALE_REVISIONS.add((template_id, revision))
+            return None
+
+    cache_key = (template_id, get_template_revision(template))
+    with COMPILED_TEMPLATE_CACHE_LOCK:
+        compiled = COMPILED_TEMPLATE_CACHE.get(cache_key)
+        if compiled is not None:
+            COMPILED_TEMPLATE_CACHE.move_to_end(cache_key)
+            return compiled
+    if not wait:
+        submit_template_compile(template)
+        return None
+    try:
+        compiled = compile_template(template)
+    except (SyntaxError, ValueError, TypeError, KeyError) as e:
+        logger.error("模板 %s 公式编译失败: %s", template_id, e)
+        return None
+    cache_compiled_template(cache_key, compiled)
+    return compiled
+
+
+def cache_compiled_template(cache_key, compiled):
+    with COMPILED_TEMPLATE_CACHE_LOCK:
+        COMPILED_TEMPLATE_CACHE[cache_key] = compiled
+        trim_compiled_template_cache()
+
+
+def estimate_compiled_bytes(compiled):
+    """估算编译结果占用的内存：numpy 数组（如网格模式的合格组合表）按实际字节数，其余按固定估算值"""
+    total = COMPILED_TEMPLATE_BASE_BYTES
+    for value in compiled.values():
+        if isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif isinstance(value, dict):
+            total += sum(item.nbytes for item in value.values() if isinstance(item, np.ndarray))
+    return total
+
+
+def trim_compiled_template_cache():
+    """按 LRU 顺序淘汰编译结果，直到条数与估算内存都不超过上限（调用方需持有 COMPILED_TEMPLATE_CACHE_LOCK）"""
+    total = sum(estimate_compiled_bytes(compiled) for compiled in COMPILED_TEMPLATE_CACHE.values())
+    while len(COMPILED_TEMPLATE_CACHE) > 1 and (len(COMPILED_TEMPLATE_CACHE) > COMPILED_TEMPLATE_CACHE_SIZE
+                                                or total > COMPILED_TEMPLATE_CACHE_MAX_BYTES):
+        _, evicted = COMPILED_TEMPLATE_CACHE.popitem(last=False)
+        total -= estimate_compiled_bytes(evicted)
+
+
+def get_compiled_template_cache_stats():
+    with COMPILED_TEMPLATE_CACHE_LOCK:
+        return {
+            'entries': len(COMPILED_TEMPLATE_CACHE),
+            'max_entries': COMPILED_TEMPLATE_CACHE_SIZE,
+            'estimated_mb': round(sum(estimate_compiled_bytes(compiled)
+                                      for compiled in COMPILED_TEMPLATE_CACHE.values()) / 1024 / 1024, 1),
+            'max_mb': COMPILED_TEMPLATE_CACHE_MAX_BYTES // 1024 // 1024,
+        }
+
+
+def evict_template_caches(template_id=None):
+    """清除本进程中某个模板（template_id 为 None 时为全部模板）各修订的缓存"""
+    def matches(key):
+        return template_id is None or key[0] == template_id
+
+    if template_id is None:
+        TEMPLATE_CACHE.clear()
     else:
-        var_values = {var: 1.0 for var in variables}
-        problem_content = format_problem_text(template['problem_text'], var_values)
+        TEMPLATE_CACHE.pop(template_id, None)
+    with COMPILED_TEMPLATE_CACHE_LOCK:
+        for key in [key for key in COMPILED_TEMPLATE_CACHE if matches(key)]:
+            del COMPILED_TEMPLATE_CACHE[key]
+    with VARIANT_CACHE_LOCK:
+        for key in [key for key in VARIANT_CACHE if matches(key)]:
+            del VARIANT_CACHE[key]
+    for cache in (LEARNED_RANGE_CACHE, VARIANT_BANKS):
+        for key in [key for key in list(cache) if matches(key)]:
+            cache.pop(key, None)
+    STALE_REVISIONS.difference_update([key for key in list(STALE_REVISIONS) if matches(key)])
+
+
+def publish_template_change(template_id=None):
+    """模板修改或删除后通知所有实例（包括本实例）清除该模板的进程内缓存；修改后可能不再适用网格模式，清除其标记"""
+    evict_template_caches(template_id)
+    try:
+        if template_id is not None:
+            redis_client.delete(get_pool_grid_key(template_id))
+        redis_client.publish(TEMPLATE_CHANGE_CHANNEL, 'all' if template_id is None else template_id)
+    except redis.RedisError as e:
+        logger.warning("发布模板 %s 修改通知失败: %s", template_id, e)
 
-    # 确保答案单位数量与答案数量匹配
-    answer_count = template.get('answer_count', 1)
-    if len(answer_units) < answer_count:
-        answer_units.extend([''] * (answer_count - len(answer_units)))
-    elif len(answer_units) > answer_count:
-        answer_units = answer_units[:answer_count]
 
-    # 格式化答案
+def listen_template_changes():
+    """订阅模板修改通知并清除本进程缓存；连接中断时可能错过通知，重连后清除全部缓存"""
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(TEMPLATE_CHANGE_CHANNEL)
+            for message in pubsub.listen():
+                data = message['data']
+                evict_template_caches(None if data == 'all' else int(data))
+        except (redis.RedisError, ValueError) as e:
+            logger.warning("模板修改通知订阅中断，5 秒后重连: %s", e)
+            time.sleep(5)
+            evict_template_caches()
+
+
+def start_template_change_listener():
+    threading.Thread(target=listen_template_changes, name='template-changes', daemon=True).start()
+
+
+def _to_answer_column(value, size):
+    column = np.asarray(value)
+    if np.iscomplexobj(column):
+        column = np.where(column.imag == 0, column.real, np.nan)
+    return np.broadcast_to(column.astype(np.float64), (size,))
+
+
+def evaluate_compiled_formula(compiled, columns, size):
+    """对整列变量值求值，返回形状为 (answer_count, size) 的 float64 数组，非法结果为 NaN。"""
+    variables = compiled['variables']
+    if compiled['evaluator'] is not None:
+        with np.errstate(all='ignore'):
+            results = compiled['evaluator'](*[np.asarray(columns[var], dtype=np.float64) for var in variables])
+        answers = [_to_answer_column(value, size) for value in results]
+    else:
+        # 含积分等符号运算的公式：逐行代入数值后求值（常量结果不逐行计算）
+        nodes = compiled['answer_nodes']
+        matrix = np.full((size, len(nodes)), np.nan)
+        for i in range(size):
+            env = {var: sp.Float(float(columns[var][i])) for var in variables}
+            for j, node in enumerate(nodes):
+                if j in compiled['constant_nodes']:
+                    continue
+                try:
+                    matrix[i, j] = float(sp.sympify(build_formula_expr(node, env)).evalf())
+                except (TypeError, ValueError, ZeroDivisionError, ArithmeticError):
+                    pass
+        answers = list(matrix.T)
+
+    answer_count = compiled['answer_count']
+    if len(answers) != answer_count:
+        answers = [answers[0]] * answer_count
+    for index, value in compiled['constant_answers'].items():
+        answers[index] = np.full(size, value)
+    return np.vstack(answers) if answers else np.empty((0, size))
+
+
+def answer_matrix_mask(compiled, answers, columns, attempt_num):
+    """只校验依赖变量的答案；常量答案不参与校验"""
+    dynamic_slots = compiled['dynamic_answer_slots']
+    if not dynamic_slots:
+        return np.ones(answers.shape[1], dtype=bool)
+    return answers_reasonable_mask(answers[dynamic_slots], columns, attempt_num, compiled['answer_constraints'])
+
+
+BATCH_OVERSAMPLE = 4  # 每轮采样行数 = 剩余所需题数 × 该倍数
+
+
+def format_correct_answers(correct_answers, max_decimals=None):
+    """格式化显示答案（根据答案大小保留适当小数位数，配置了 max_decimals 时不超过该位数）"""
     formatted_correct_answers = []
     for answer in correct_answers:
         abs_answer = abs(answer)
-        if abs_answer >= 1000:
-            formatted_correct_answers.append(round(answer, 0))
+        if abs_answer == 0:
+            formatted_correct_answers.append(0.0)
+            continue
+        elif abs_answer >= 1000:
+            decimals = 0
         elif abs_answer >= 1:
-            formatted_correct_answers.append(round(answer, 2))
+            decimals = 2
+        elif abs_answer >= 0.01:
+            decimals = 4
         else:
-            formatted_correct_answers.append(round(answer, 4))
+            decimals = 6
+        if max_decimals is not None:
+            decimals = min(decimals, max_decimals)
+        formatted_correct_answers.append(round(answer, decimals))
+    return formatted_correct_answers
+
+
+def build_variable_lattice(variables, ranges, specs=None):
+    """为每个变量建立采样网格：所有可能采到的值（含逐次扩大与回退）都落在网格点上。
 
-    result_data = {
-        'problem_text': problem_content,
+    网格点 = level * unit / scale，level 取值 low_level .. low_level + radix - 1。
+    配置了 step/decimals 的变量按步长和小数位建网格，其余默认保留 VARIANT_DECIMALS 位小数。
+    """
+    lattice = {}
+    for var in variables:
+        spec = (specs or {}).get(var, {})
+        decimals = spec.get('decimals', VARIANT_DECIMALS)
+        step = spec.get('step')
+        if step is not None:
+            step_text = repr(float(step))
+            step_decimals = len(step_text.split('.')[1].rstrip('0')) if '.' in step_text else 0
+            decimals = max(decimals, step_decimals)
+        scale = 10 ** decimals
+        unit = max(1, round(step * scale)) if step is not None else 1
+        min_val, max_val = ranges[var]
+        low = min(0.0, min_val)
+        high = max(1.0, max_val, get_outer_range(ranges[var])[1])
+        low_level = math.floor(low * scale / unit)
+        high_level = math.ceil(high * scale / unit)
+        lattice[var] = {'scale': scale, 'unit': unit, 'low_level': low_level, 'radix': high_level - low_level + 1}
+    return lattice
+
+
+def snap_to_lattice(compiled, var, values, low=None, high=None):
+    """把采样值吸附到变量网格点上（超出网格的值截断到边界）。
+
+    给定逐行上下限 low/high 时只吸附到约束区间内的网格点，区间内没有网格点的行返回 NaN。
+    """
+    spec = compiled['lattice'][var]
+    min_level = spec['low_level']
+    max_level = spec['low_level'] + spec['radix'] - 1
+    levels = np.rint(np.asarray(values, dtype=np.float64) * spec['scale'] / spec['unit'])
+    if low is None:
+        return np.clip(levels, min_level, max_level) * spec['unit'] / spec['scale']
+
+    # 留出浮点误差，避免约束端点恰好落在网格点上时被排除
+    low_level = np.maximum(np.ceil(np.asarray(low) * spec['scale'] / spec['unit'] - 1e-9), min_level)
+    high_level = np.minimum(np.floor(np.asarray(high) * spec['scale'] / spec['unit'] + 1e-9), max_level)
+    levels = np.clip(levels, low_level, high_level) * spec['unit'] / spec['scale']
+    return np.where(low_level <= high_level, levels, np.nan)
+
+
+def fill_derived_columns(compiled, columns, size):
+    """按依赖顺序计算派生变量列（按显示小数位取整，保证题面数值与答案一致）"""
+    for var in compiled['variable_order']:
+        rule = compiled['variable_rules'].get(var)
+        if rule and 'derived' in rule:
+            decimals = compiled['var_decimals'].get(var, VARIANT_DECIMALS)
+            with np.errstate(all='ignore'):
+                columns[var] = np.round(evaluate_variable_expression(rule['derived'], columns, size), decimals)
+    return columns
+
+
+def encode_variant_seed(compiled, var_values):
+    """把网格上的变量值编码为 seed（各变量网格序号的混合进制数）"""
+    seed = 0
+    for var in reversed(compiled['sampled_variables']):
+        spec = compiled['lattice'][var]
+        offset = round(var_values[var] * spec['scale'] / spec['unit']) - spec['low_level']
+        seed = seed * spec['radix'] + offset
+    return seed
+
+
+def decode_variant_seed(compiled, seed):
+    """encode_variant_seed 的逆运算（派生变量由采样变量重新计算）"""
+    var_values = {}
+    for var in compiled['sampled_variables']:
+        spec = compiled['lattice'][var]
+        seed, offset = divmod(seed, spec['radix'])
+        var_values[var] = (spec['low_level'] + offset) * spec['unit'] / spec['scale']
+    if len(var_values) < len(compiled['variables']):
+        columns = fill_derived_columns(compiled, {var: np.array([value]) for var, value in var_values.items()}, 1)
+        var_values = {var: float(columns[var][0]) for var in compiled['variables']}
+    return var_values
+
+
+def build_problem_data(compiled, var_values, correct_answers, seed):
+    """由变量值和答案构建题目数据（包含答案单位）"""
+    template = compiled['template']
+    # 无法求出有限值的答案按 0 处理（与回退方案一致）
+    correct_answers = [answer if math.isfinite(answer) else 0.0 for answer in correct_answers]
+    return {
+        'problem_text': render_problem_text(compiled, var_values),
         'var_values': var_values,
-        'correct_answers': formatted_correct_answers,
-        'answer_units': answer_units,  # 包含答案单位
-        'template_id': template['id'],
-        'answer_count': template.get('answer_count', 1),
+        'correct_answers': format_correct_answers(correct_answers, compiled['answer_constraints'].get('max_decimals')),
+        'answer_units': list(compiled['answer_units']),
+        'template_id': compiled['template_id'],
+        'answer_count': compiled['answer_count'],
         'template_name': template['template_name'],
-        'image_filename': template.get('image_filename')
+        'image_filename': template.get('image_filename'),
+        'revision': compiled['revision'],
+        'seed': seed
     }
 
-    print(f"⚠️ 使用回退方案生成题目 - 模板: {template['template_name']}")
-    print(f"   变量值: {var_values}")
-    print(f"   正确答案: {formatted_correct_answers}")
-    print(f"   答案单位: {answer_units}")
+
+def build_problem_from_seed(compiled, seed):
+    """由 seed 确定性地重建题目"""
+    var_values = decode_variant_seed(compiled, seed)
+    columns = {var: np.array([value]) for var, value in var_values.items()}
+    correct_answers = evaluate_compiled_formula(compiled, columns, 1)[:, 0].tolist()
+    return build_problem_data(compiled, var_values, correct_answers, seed)
+
+
+def encode_variant_seeds(compiled, columns):
+    """encode_variant_seed 的整列版本，返回 int64 数组"""
+    seeds = np.zeros(len(next(iter(columns.values()))), dtype=np.int64)
+    for var in reversed(compiled['sampled_variables']):
+        spec = compiled['lattice'][var]
+        offsets = np.rint(columns[var] * spec['scale'] / spec['unit']).astype(np.int64) - spec['low_level']
+        seeds = seeds * spec['radix'] + offsets
+    return seeds
+
+
+def build_variant_grid(compiled):
+    """网格模式：枚举配置范围内全部网格点组合，向量化求值，返回合格组合的 seed 数组。
+
+    组合数超过 GRID_MAX_COMBINATIONS 或 seed 超出 int64 时返回 None（改用随机采样）；
+    校验标准与随机采样一致，首轮标准下没有合格组合时逐轮放宽。
+    """
+    sampled_variables = compiled['sampled_variables']
+    if math.prod(compiled['lattice'][var]['radix'] for var in sampled_variables) >= 2 ** 63:
+        return None
+
+    level_ranges = []
+    for var in sampled_variables:
+        spec = compiled['lattice'][var]
+        min_val, max_val = compiled['configured_ranges'][var]
+        low_level = math.ceil(max(0.01, min_val) * spec['scale'] / spec['unit'] - 1e-9)
+        high_level = math.floor(max_val * spec['scale'] / spec['unit'] + 1e-9)
+        level_ranges.append((low_level, max(0, high_level - low_level + 1)))
+    total = math.prod(count for _, count in level_ranges)
+    if total == 0 or total > GRID_MAX_COMBINATIONS:
+        return None
+
+    indexes = np.unravel_index(np.arange(total), [count for _, count in level_ranges])
+    columns = {}
+    for var, (low_level, _), index in zip(sampled_variables, level_ranges, indexes):
+        spec = compiled['lattice'][var]
+        columns[var] = (low_level + index) * spec['unit'] / spec['scale']
+
+    # 带表达式上下限的变量按约束过滤，派生变量按公式计算
+    valid = np.ones(total, dtype=bool)
+    with np.errstate(all='ignore'):
+        for var in compiled['variable_order']:
+            rule = compiled['variable_rules'].get(var)
+            if not rule or 'derived' in rule:
+                continue
+            for key, compare in (('lower', np.greater_equal), ('upper', np.less_equal)):
+                bound = rule[key]
+                if isinstance(bound, dict):
+                    bound = evaluate_variable_expression(bound, columns, total)
+                valid &= compare(columns[var] + (1e-9 if key == 'lower' else -1e-9), bound)
+    fill_derived_columns(compiled, columns, total)
+    for var in compiled['variable_rules']:
+        valid &= np.isfinite(columns[var])
+
+    answers = evaluate_compiled_formula(compiled, columns, total)
+    for attempt in range(10):
+        mask = valid & answer_matrix_mask(compiled, answers, columns, attempt)
+        if mask.any():
+            break
+    sampled_columns = {var: columns[var][mask] for var in sampled_variables}
+    return encode_variant_seeds(compiled, sampled_columns) if mask.any() else np.empty(0, dtype=np.int64)
+
+
+def get_variant_grid(compiled):
+    """获取模板的合格组合表（每个进程每个修订只枚举一次）；不适用网格模式时返回 None"""
+    if 'grid' not in compiled:
+        grid = None
+        if compiled['template_kind'] != 'static' and compiled['evaluator'] is not None:
+            started = time.time()
+            grid = build_variant_grid(compiled)
+            if grid is not None:
+                print(f"🔢 模板 {compiled['template_id']} 使用网格模式：合格组合 {len(grid)} 个"
+                      f"（{time.time() - started:.2f}s）")
+                if not len(grid):
+                    grid = None
+        compiled['grid'] = grid
+        if grid is not None:
+            with COMPILED_TEMPLATE_CACHE_LOCK:
+                trim_compiled_template_cache()
+    return compiled['grid']
+
+
+def get_ready_variant_grid(compiled):
+    """请求线程使用：只返回已枚举好的合格组合表；尚未枚举时提交到进程池（随编译一起完成），本次返回 None"""
+    if 'grid' not in compiled:
+        submit_template_compile(compiled['template'])
+        return None
+    return compiled['grid']
+
+
+def pick_grid_problems(compiled, n, rng=None):
+    """从合格组合表中随机取 n 道题（组合数不足时允许重复）"""
+    grid = compiled['grid']
+    rng = rng or np.random.default_rng()
+    seeds = rng.choice(grid, size=n, replace=len(grid) < n)
+    return [build_problem_from_seed(compiled, int(seed)) for seed in seeds]
+
+
+def get_learned_ranges(compiled):
+    """读取各实例共享的学习区间：合格样本足够的变量返回观测合格区间（含探索余量）"""
+    cache_key = (compiled['template_id'], compiled['revision'])
+    cached = LEARNED_RANGE_CACHE.get(cache_key)
+    if cached and time.time() - cached[0] < LEARNED_RANGE_CACHE_SECONDS:
+        return cached[1]
+
+    try:
+        stats = redis_client.hgetall(get_learned_range_key(*cache_key))
+    except redis.RedisError as e:
+        logger.warning("读取模板 %s 学习区间失败: %s", compiled['template_id'], e)
+        stats = {}
+
+    learned_ranges = {}
+    for var in compiled['variables']:
+        if int(stats.get(f'{var}:accepted', 0)) < LEARNED_RANGE_MIN_ACCEPTED:
+            continue
+        valid_min = float(stats[f'{var}:min'])
+        valid_max = float(stats[f'{var}:max'])
+        margin = (valid_max - valid_min) * LEARNED_RANGE_MARGIN
+        valid_min, valid_max = valid_min - margin, valid_max + margin
+
+        # 只在配置范围内收缩；合格区间完全落在配置范围外时（配置不当），退而使用扩大后的最大范围
+        for bound_min, bound_max in (compiled['ranges'][var], get_outer_range(compiled['ranges'][var])):
+            learned_min, learned_max = max(valid_min, bound_min), min(valid_max, bound_max)
+            if learned_min < learned_max:
+                learned_ranges[var] = (learned_min, learned_max)
+                break
+
+    LEARNED_RANGE_CACHE[cache_key] = (time.time(), learned_ranges)
+    return learned_ranges
+
+
+def record_sampling_stats(compiled, sampling_stats):
+    """把一次批量生成的采样统计合并到 Redis（每个变量：接受数、拒绝数、合格最小值、合格最大值）"""
+    if not sampling_stats:
+        return
+    args = [LEARNED_RANGE_TTL_SECONDS]
+    for var, (accepted, rejected, valid_min, valid_max) in sampling_stats.items():
+        args.extend([var, accepted, rejected, repr(valid_min), repr(valid_max)])
+    try:
+        RECORD_SAMPLING_STATS_SCRIPT(
+            keys=[get_learned_range_key(compiled['template_id'], compiled['revision'])], args=args)
+    except redis.RedisError as e:
+        logger.warning("记录模板 %s 采样统计失败: %s", compiled['template_id'], e)
+
+
+def get_outer_range(value_range, max_attempts=10):
+    """配置范围经逐次扩大后可能达到的最大采样范围"""
+    min_val, max_val = value_range
+    range_expansion = 1.0 + ((max_attempts - 1) * 0.1)
+    return max(0.01, min_val / range_expansion), max_val * range_expansion
+
+
+def sample_unit_column(rng, size, sampler):
+    """生成一列 [0, 1) 上的采样点：lhs 把区间等分为 size 份、每份恰好取一个点，random 为独立均匀采样"""
+    if sampler == 'lhs':
+        return (rng.permutation(size) + rng.random(size)) / size
+    return rng.random(size)
+
+
+def sample_variable_matrix(compiled, ranges, attempt, size, rng):
+    """按尝试次数扩大后的范围整列采样变量值（吸附到变量网格，默认保留两位小数）。
+
+    按依赖顺序采样：带表达式上下限的变量直接在逐行约束区间内采样，派生变量由公式计算。
+    """
+    columns = {}
+    range_expansion = 1.0 + (attempt * 0.1)  # 每次尝试扩大10%
+    for var in compiled['variable_order']:
+        rule = compiled['variable_rules'].get(var)
+        if rule and 'derived' in rule:
+            continue
+        min_val, max_val = ranges.get(var, (1.0, 3.0))
+        expanded_min = max(0.01, min_val / range_expansion)
+        expanded_max = max_val * range_expansion
+        unit = sample_unit_column(rng, size, compiled['sampler'])
+        if not rule:
+            columns[var] = snap_to_lattice(compiled, var, expanded_min + (expanded_max - expanded_min) * unit)
+            continue
+
+        # 约束上下限是硬约束；与（学习/扩大后的）范围无交集的行退回只用硬约束
+        with np.errstate(all='ignore'):
+            hard_low = evaluate_variable_expression(rule['lower'], columns, size) \
+                if isinstance(rule['lower'], dict) else np.full(size, rule['lower'])
+            hard_high = evaluate_variable_expression(rule['upper'], columns, size) \
+                if isinstance(rule['upper'], dict) else np.full(size, rule['upper'])
+        low = np.maximum(hard_low, expanded_min)
+        high = np.minimum(hard_high, expanded_max)
+        empty = ~(low <= high)
+        low = np.where(empty, hard_low, low)
+        high = np.where(empty, hard_high, high)
+        invalid = ~(np.isfinite(low) & np.isfinite(high) & (low <= high))
+        low = np.where(invalid, 0.0, low)
+        high = np.where(invalid, 1.0, high)
+        values = low + (high - low) * unit
+        columns[var] = np.where(invalid, np.nan, snap_to_lattice(compiled, var, values, low, high))
+    return fill_derived_columns(compiled, columns, size)
+
+
+def generate_problems_batch(template_id, n, max_attempts=10, fallback=True, report=None, quiet=False):
+    """批量生成 n 道题目：整列采样变量、向量化求值并用掩码校验，取前 n 个合格行。
+
+    每一轮对应单题生成中的一次尝试（范围与校验标准随轮次放宽），
+    全部轮次后仍不足的部分使用回退方案补齐（fallback=False 时只返回通过校验的题目）。
+    传入 report 字典时累加采样行数、拒绝行数、通过校验题数与回退题数（sampled/rejected/generated/fallback）。
+    quiet=True 时（生成审核）不输出日志，也不把采样统计写入 Redis。
+    """
+    compiled = get_compiled_template(template_id)
+
+    if not compiled or n <= 0:
+        return []
+
+    template = compiled['template']
+    variables = compiled['variables']
+    rng = np.random.default_rng()
+
+    # 静态模板只有一道题；网格模式直接从合格组合表中取题，无需采样与校验
+    if compiled['template_kind'] == 'static' or get_variant_grid(compiled) is not None:
+        if compiled['template_kind'] == 'static':
+            problems = [get_static_problem(compiled)] * n
+        else:
+            problems = pick_grid_problems(compiled, n, rng)
+        if report is not None:
+            report['generated'] = report.get('generated', 0) + len(problems)
+        return problems
+
+    # 优先使用各实例共享的学习区间，统计不足的变量沿用配置范围
+    reasonable_ranges = dict(compiled['ranges'])
+    reasonable_ranges.update(get_learned_ranges(compiled))
+
+    # 变量 -> [接受数, 拒绝数, 合格最小值, 合格最大值]
+    sampling_stats = {var: [0, 0, math.inf, -math.inf] for var in variables}
+
+    problems = []
+    generated_seeds = set()
+    duplicate_rows = []
+    for attempt in range(max_attempts):
+        remaining = n - len(problems)
+        if remaining <= 0:
+            break
+
+        # 含符号运算的公式逐行求值，不做过量采样
+        size = remaining * BATCH_OVERSAMPLE if compiled['evaluator'] is not None else remaining
+        columns = sample_variable_matrix(compiled, reasonable_ranges, attempt, size, rng)
+        answers = evaluate_compiled_formula(compiled, columns, size)
+        mask = answer_matrix_mask(compiled, answers, columns, attempt)
+        for var in compiled['variable_rules']:
+            # 约束区间为空或派生值非法的行
+            mask &= np.isfinite(columns[var])
+
+        valid_rows = np.flatnonzero(mask)
+        if report is not None:
+            report['sampled'] = report.get('sampled', 0) + size
+            report['rejected'] = report.get('rejected', 0) + size - len(valid_rows)
+        for var in variables:
+            stats = sampling_stats[var]
+            stats[0] += len(valid_rows)
+            stats[1] += size - len(valid_rows)
+            if len(valid_rows):
+                stats[2] = min(stats[2], float(columns[var][valid_rows].min()))
+                stats[3] = max(stats[3], float(columns[var][valid_rows].max()))
+
+        accepted_rows = []
+        for row in valid_rows:
+            if len(accepted_rows) >= remaining:
+                break
+            var_values = {var: float(columns[var][row]) for var in variables}
+            seed = encode_variant_seed(compiled, var_values)
+            if seed in generated_seeds:  # 同一批内吸附到同一网格点的重复变体，合格变体不足时再使用
+                if len(duplicate_rows) < remaining:
+                    duplicate_rows.append((var_values, answers[:, row].tolist(), seed))
+                continue
+            generated_seeds.add(seed)
+            accepted_rows.append(row)
+            problems.append(build_problem_data(compiled, var_values, answers[:, row].tolist(), seed))
+        accepted_rows = np.array(accepted_rows, dtype=np.int64)
+
+        if len(accepted_rows):
+            # 在内存中更新合理范围（仅本次调用有效）
+            for var in variables:
+                accepted = columns[var][accepted_rows]
+                current_min, current_max = reasonable_ranges[var]
+                reasonable_ranges[var] = (
+                    min(current_min, float(accepted.min()) * 0.8),  # 稍微扩大下限
+                    max(current_max, float(accepted.max()) * 1.2)  # 稍微扩大上限
+                )
+
+    if not quiet:
+        record_sampling_stats(compiled, {
+            var: tuple(stats) for var, stats in sampling_stats.items() if stats[0] + stats[1] > 0
+        })
+
+    while duplicate_rows and len(problems) < n:
+        problems.append(build_problem_data(compiled, *duplicate_rows.pop()))
+
+    generated = len(problems)
+    while fallback and len(problems) < n:
+        # 最终回退：使用保守但保证成功的方法
+        problems.append(generate_fallback_problem(compiled, reasonable_ranges, quiet))
+
+    if report is not None:
+        report['generated'] = report.get('generated', 0) + generated
+        report['fallback'] = report.get('fallback', 0) + len(problems) - generated
+
+    if not quiet:
+        print(f"✅ 批量生成题目 - 模板: {template['template_name']}，"
+              f"通过校验 {generated} 道，回退 {len(problems) - generated} 道")
+    return problems
+
+
+def generate_problem_from_template(template_id, max_attempts=10):
+    """从模板生成单道题目（批量生成 n=1 的特例）"""
+    problems = generate_problems_batch(template_id, 1, max_attempts)
+    return problems[0] if problems else None
+
+
+def generate_fallback_problem(compiled, reasonable_ranges=None, quiet=False):
+    """最终回退方案：使用保守范围生成题目"""
+    template = compiled['template']
+    variables = compiled['variables']
+    answer_constraints = compiled['answer_constraints']
+
+    rng = np.random.default_rng()
+    for attempt in range(5):
+        columns = sample_variable_matrix(compiled, reasonable_ranges or {}, 0, 1, rng)
+        var_values = {var: float(columns[var][0]) for var in variables}
+        current_answers = evaluate_compiled_formula(compiled, columns, 1)[:, 0].tolist()
+        dynamic_answers = [current_answers[index] for index in compiled['dynamic_answer_slots']]
+
+        if all(math.isfinite(value) for value in var_values.values()) and (
+                not dynamic_answers
+                or is_answer_reasonable_dynamic(dynamic_answers, var_values, attempt, answer_constraints)):
+            break
+    else:
+        # 全部失败时取采样变量为 1，答案仍按公式计算，保证由 seed 可复现
+        var_values = {var: 1.0 for var in compiled['sampled_variables']}
+
+    result_data = build_problem_from_seed(compiled, encode_variant_seed(compiled, var_values))
+    var_values = result_data['var_values']
+
+    if not quiet:
+        print(f"⚠️ 使用回退方案生成题目 - 模板: {template['template_name']}")
+        print(f"   变量值: {var_values}")
+        print(f"   正确答案: {result_data['correct_answers']}")
+        print(f"   答案单位: {result_data['answer_units']}")
 
     return result_data
 
@@ -1041,36 +3317,121 @@ def check_dynamic_consistency(answer, var_values, attempt_num):
     return True
 
 
-def format_problem_text(problem_text, var_values):
-    """格式化问题文本"""
-    pattern = r'__(\w+)__'
+def answers_reasonable_mask(answers, columns, attempt_num, constraints=None):
+    """is_answer_reasonable_dynamic 的向量化版本：answers 形状为 (answer_count, size)，返回每行是否合格"""
+    size = answers.shape[1]
+    if answers.shape[0] == 0:
+        return np.zeros(size, dtype=bool)
+
+    constraints = constraints or {}
+    min_answer = constraints.get('min_answer')
+    max_answer = constraints.get('max_answer')
+    non_negative = constraints.get('non_negative', False)
 
-    def replace_var(match):
-        var_name = match.group(1)
-        return str(var_values.get(var_name, match.group(0)))
+    # 动态阈值：随着尝试次数增加，逐渐放宽标准
+    max_threshold = 1e6 * (1 + attempt_num * 0.2)
+    min_threshold = 1e-8 / (1 + attempt_num * 0.2)
+    if max_answer is not None:
+        max_threshold = min(max_threshold, max_answer)
+    if min_answer is not None:
+        min_threshold = max(min_threshold, min_answer)
 
-    return re.sub(pattern, replace_var, problem_text)
+    with np.errstate(invalid='ignore'):
+        finite = np.isfinite(answers)
+        safe_answers = np.where(finite, answers, 0.0)
+        abs_answers = np.abs(safe_answers)
 
+        row_ok = finite.all(axis=0)
+        if non_negative:
+            row_ok &= (safe_answers >= 0).all(axis=0)
+        out_of_range = (abs_answers > max_threshold) | ((abs_answers > 0) & (abs_answers < min_threshold))
+        row_ok &= ~out_of_range.any(axis=0)
+        row_ok &= dynamic_consistency_mask(abs_answers, columns, attempt_num).all(axis=0)
+    return row_ok
+
+
+def dynamic_consistency_mask(abs_answers, columns, attempt_num):
+    """check_dynamic_consistency 的向量化版本，返回与 abs_answers 同形状的布尔数组"""
+    if not columns:
+        return np.ones(abs_answers.shape, dtype=bool)
+
+    avg_var = np.mean(np.abs(np.vstack([np.asarray(column, dtype=np.float64) for column in columns.values()])), axis=0)
+
+    relaxation_factor = 1 + (attempt_num * 0.3)  # 每次尝试放宽30%
+    max_ratio = 1000 * relaxation_factor
+    min_ratio = 0.001 / relaxation_factor
+
+    ratio_to_avg = np.where(avg_var > 0, abs_answers / np.where(avg_var > 0, avg_var, 1.0), abs_answers)
+    return (ratio_to_avg <= max_ratio) & (ratio_to_avg >= min_ratio)
+
+
+PLACEHOLDER_PATTERN = re.compile(r'__(\w+)__')
+
+
+def split_problem_text(problem_text, variables):
+    """加载模板时把题目文本切分为字面量片段和变量占位槽，非模板变量的占位符并入字面量。
+
+    返回 (literals, slots)，len(literals) == len(slots) + 1。
+    """
+    literals = []
+    slots = []
+    current = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(problem_text or ''):
+        current.append(problem_text[position:match.start()])
+        if match.group(1) in variables:
+            literals.append(''.join(current))
+            slots.append(match.group(1))
+            current = []
+        else:
+            current.append(match.group(0))
+        position = match.end()
+    current.append((problem_text or '')[position:])
+    literals.append(''.join(current))
+    return literals, slots
+
+
+def format_variable_value(value, decimals=None):
+    """按变量的格式规则输出数值：指定小数位时定长输出，否则与旧版 str() 一致"""
+    if decimals is None:
+        return str(value)
+    return f"{value:.{decimals}f}"
+
+
+def render_problem_text(compiled, var_values):
+    """用预切分的片段拼接题目文本"""
+    literals = compiled['text_literals']
+    var_decimals = compiled['var_decimals']
+    parts = [literals[0]]
+    for var, literal in zip(compiled['text_slots'], literals[1:]):
+        if var in var_values:
+            parts.append(format_variable_value(var_values[var], var_decimals.get(var)))
+        else:
+            parts.append(f'__{var}__')
+        parts.append(literal)
+    return ''.join(parts)
 
 
-def parse_variable_specs(variables_text):
-    """支持 `v[1,5],a[0.1,2],t` 的轻量范围语法；未配置时沿用默认范围。"""
-    if not variables_text:
-        return [], {}
 
-    tokens = []
+VARIABLE_SPEC_OPTIONS = {'step': float, 'decimals': int}
+NUMBER_PATTERN = re.compile(r'^-?\d+(?:\.\d+)?$')
+
+
+def split_spec_items(text):
+    """按顶层逗号切分（忽略方括号和圆括号内的逗号）"""
+    items = []
     current = []
-    bracket_depth = 0
-    for ch in variables_text:
-        if ch == '[':
-            bracket_depth += 1
-        elif ch == ']':
-            bracket_depth = max(0, bracket_depth - 1)
-
-        if ch == ',' and bracket_depth == 0:
-            token = ''.join(current).strip()
-            if token:
-                tokens.append(token)
+    depth = 0
+    for ch in text:
+        if ch in '[(':
+            depth += 1
+        elif ch in '])':
+            depth = max(0, depth - 1)
+
+        if ch == ',' and depth == 0:
+            item = ''.join(current).strip()
+            if item:
+                items.append(item)
             current = []
             continue
 
@@ -1078,24 +3439,68 @@ def parse_variable_specs(variables_text):
 
     tail = ''.join(current).strip()
     if tail:
-        tokens.append(tail)
+        items.append(tail)
+    return items
+
+
+def parse_variable_specs(variables_text):
+    """解析变量定义，支持：
+
+    - `v[1,5],a[0.1,2],t`：独立范围，未配置时沿用默认范围
+    - `x[1,AC]`、`x[0.1,AC-0.1]`：上下限可以是其他变量的表达式（x 在 AC 确定后直接在约束区间内采样）
+    - `L2=2*L1`：派生变量，由其他变量计算得到，不参与采样
+    - `v0[0,30,step=0.5]`、`m[1,5,decimals=1]`：采样步长与显示小数位
+
+    返回 (variables, ranges, specs)：ranges 只包含上下限都是数值的变量，
+    specs 记录表达式上下限（lower/upper）、派生表达式（derived）以及 step/decimals。
+    """
+    if not variables_text:
+        return [], {}, {}
 
     variables = []
     ranges = {}
-    for token in tokens:
-        match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\[\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*\]$', token)
-        if match:
-            name = match.group(1)
-            min_val = float(match.group(2))
-            max_val = float(match.group(3))
-            if min_val > max_val:
-                min_val, max_val = max_val, min_val
+    specs = {}
+    for token in split_spec_items(variables_text):
+        range_match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\[(.*)\]$', token)
+        derived_match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.+)$', token)
+        if range_match:
+            name = range_match.group(1)
+            items = split_spec_items(range_match.group(2))
+            bounds = [item for item in items if '=' not in item]
+            if len(bounds) != 2:
+                raise ValueError(f"变量 {name} 的范围需要恰好两个上下限: {token}")
+
+            spec = {}
+            for item in items:
+                if '=' not in item:
+                    continue
+                key, value = (part.strip() for part in item.split('=', 1))
+                if key not in VARIABLE_SPEC_OPTIONS:
+                    raise ValueError(f"变量 {name} 不支持的选项: {key}")
+                spec[key] = VARIABLE_SPEC_OPTIONS[key](value)
+            if spec.get('step') is not None and spec['step'] <= 0:
+                raise ValueError(f"变量 {name} 的 step 必须为正数")
+
+            lower, upper = bounds
+            if NUMBER_PATTERN.match(lower) and NUMBER_PATTERN.match(upper):
+                min_val, max_val = float(lower), float(upper)
+                if min_val > max_val:
+                    min_val, max_val = max_val, min_val
+                ranges[name] = (min_val, max_val)
+            else:
+                spec['lower'] = float(lower) if NUMBER_PATTERN.match(lower) else lower
+                spec['upper'] = float(upper) if NUMBER_PATTERN.match(upper) else upper
             variables.append(name)
-            ranges[name] = (min_val, max_val)
+            if spec:
+                specs[name] = spec
+        elif derived_match:
+            name = derived_match.group(1)
+            variables.append(name)
+            specs[name] = {'derived': derived_match.group(2).strip()}
         else:
             variables.append(token)
 
-    return variables, ranges
+    return variables, ranges, specs
 
 
 def parse_answer_units(template):
@@ -1116,6 +3521,22 @@ def infer_answer_constraints(answer_units):
         'max_answer': 1e7
     }
 
+ANSWER_CONSTRAINT_FIELDS = ('min_answer', 'max_answer', 'non_negative', 'max_decimals')
+
+
+def merge_answer_constraints(inferred, template):
+    """用模板配置的答案约束（answer_constraints 列，JSON）覆盖按单位推断的约束"""
+    raw = template.get('answer_constraints')
+    if not raw:
+        return inferred
+    configured = json.loads(raw) if isinstance(raw, str) else raw
+    merged = dict(inferred)
+    merged.update({key: configured[key] for key in ANSWER_CONSTRAINT_FIELDS if key in configured})
+    if configured.get('non_negative') is False and 'min_answer' not in configured:
+        merged['min_answer'] = None
+    return merged
+
+
 def classify_error_type(user_answer, correct_answer, is_correct):
     """根据用户答案与正确答案的差异推断错误类型"""
     if is_correct:
@@ -1143,8 +3564,8 @@ def classify_error_type(user_answer, correct_answer, is_correct):
 
 
 def save_user_response(user_id, template_id, paper_id, problem_text, user_answers, correct_answers, is_correct_list,
-                       attempt_count, time_taken, error_types=None):
-    """保存用户答题记录（支持多答案）"""
+                       attempt_count, time_taken, error_types=None, variant_revision=None, variant_seed=None):
+    """保存用户答题记录（支持多答案）；记录题目的修订号与 seed，便于复现"""
     print(f"\n=== 保存答题记录开始 ===")
     print(f"用户ID: {user_id}")
     print(f"模板ID: {template_id}")
@@ -1204,10 +3625,12 @@ def save_user_response(user_id, template_id, paper_id, problem_text, user_answer
                 cursor.execute("""
                     INSERT INTO user_responses
                     (user_id, template_id, problem_text, user_answer,
-                     correct_answer, is_correct, error_type, attempt_count, time_taken, answer_index)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                     correct_answer, is_correct, error_type, attempt_count, time_taken, answer_index,
+                     variant_revision, variant_seed)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """, (user_id, template_id, truncated_problem_text, user_answer,
-                      correct_answer, is_correct, error_type, attempt_count, time_taken, i))
+                      correct_answer, is_correct, error_type, attempt_count, time_taken, i,
+                      variant_revision, None if variant_seed is None else str(variant_seed)))
 
                 saved_count += 1
                 print(f"✅ 答案 {i + 1} 保存成功")
@@ -1295,6 +3718,16 @@ def repair_database():
             print("已添加 problem_templates.paper_id 列")
         cursor.execute("UPDATE problem_templates SET paper_id = %s WHERE paper_id IS NULL", (default_paper_id,))
 
+        cursor.execute("SHOW COLUMNS FROM problem_templates LIKE 'answer_constraints'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE problem_templates ADD COLUMN answer_constraints TEXT NULL AFTER answer_units")
+            print("已添加 problem_templates.answer_constraints 列")
+
+        cursor.execute("SHOW COLUMNS FROM problem_templates LIKE 'revision'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE problem_templates ADD COLUMN revision INT NOT NULL DEFAULT 1 AFTER answer_constraints")
+            print("已添加 problem_templates.revision 列")
+
         cursor.execute("SHOW COLUMNS FROM user_responses LIKE 'paper_id'")
         if not cursor.fetchone():
             cursor.execute("ALTER TABLE user_responses ADD COLUMN paper_id INT DEFAULT NULL AFTER answer_index")
@@ -1306,6 +3739,12 @@ def repair_database():
             WHERE ur.paper_id IS NULL
         """)
 
+        cursor.execute("SHOW COLUMNS FROM user_responses LIKE 'variant_seed'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE user_responses ADD COLUMN variant_revision VARCHAR(32) DEFAULT NULL AFTER paper_id")
+            cursor.execute("ALTER TABLE user_responses ADD COLUMN variant_seed VARCHAR(64) DEFAULT NULL AFTER variant_revision")
+            print("已添加 user_responses.variant_revision / variant_seed 列")
+
         cursor.execute("SHOW COLUMNS FROM user_responses LIKE 'error_type'")
         if not cursor.fetchone():
             cursor.execute("ALTER TABLE user_responses ADD COLUMN error_type VARCHAR(50) DEFAULT '未知' AFTER is_correct")
@@ -1394,6 +3833,8 @@ def initialize_database():
         solution_formula TEXT NOT NULL,
         answer_count INT DEFAULT 1,
         answer_units TEXT,  -- 新增：答案单位字段
+        answer_constraints TEXT NULL,  -- 答案约束（JSON，可选），覆盖按单位推断的约束
+        revision INT NOT NULL DEFAULT 1,  -- 修订号，每次编辑加 1
         difficulty VARCHAR(20) DEFAULT 'medium',
         image_filename VARCHAR(255) NULL,
         paper_id INT DEFAULT NULL,
@@ -1417,6 +3858,8 @@ def initialize_database():
         response_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         answer_index INT DEFAULT 0,
         paper_id INT DEFAULT NULL,
+        variant_revision VARCHAR(32) DEFAULT NULL,
+        variant_seed VARCHAR(64) DEFAULT NULL,
         FOREIGN KEY (user_id) REFERENCES users(id),
         FOREIGN KEY (template_id) REFERENCES problem_templates(id),
         FOREIGN KEY (paper_id) REFERENCES exam_papers(id)
@@ -1534,7 +3977,7 @@ def initialize_database():
                     </div>
                 </div>
             """,
-            'variables': 'v,AC,dBdt,B,x',
+            'variables': 'v,AC,dBdt,B,x[0.1,AC]',
             'formula': "B * v * (AC/100), (B * v * (AC/100)) + (dBdt * (x/100) * (AC/100)), 1",
             'answer_count': 3,
             'answer_units': 'V,V,-',  # 前两个是伏特，第三个是无量纲
@@ -2487,10 +4930,12 @@ def debug_images():
 
 @app.route('/debug/reload_templates', methods=['GET'])
 def reload_templates():
-    global TEMPLATE_CACHE, TEMPLATE_CACHE_TS
-    TEMPLATE_CACHE = {}
+    global TEMPLATE_CACHE_TS
+    # 通知所有实例清空模板缓存（本实例同时清空）
+    publish_template_change()
     TEMPLATE_CACHE_TS = time.time()
-    return jsonify({'success': True, 'message': '模板缓存已清空', 'timestamp': TEMPLATE_CACHE_TS})
+    return jsonify({'success': True, 'message': '所有实例的模板缓存已清空', 'timestamp': TEMPLATE_CACHE_TS,
+                    'compiled_cache': get_compiled_template_cache_stats()})
 
 
 @app.route('/history')
@@ -2607,9 +5052,9 @@ def refresh_problem(problem_id):
         if actual_id is None:
             return jsonify({'success': False, 'message': '无效的题目编号'})
 
-        token, problem_data = fetch_problem_from_pool(actual_id)
+        token, problem_data = fetch_problem_from_pool(actual_id, session.get('user_id'))
         if not problem_data:
-            token, problem_data = generate_and_cache_problem(actual_id)
+            token, problem_data = generate_and_cache_problem(actual_id, session.get('user_id'))
 
         if not problem_data or not token:
             return jsonify({'success': False, 'message': '题目生成失败'})
@@ -2667,10 +5112,10 @@ def problem_ajax(problem_id):
 
     if not problem_data:
         print(f"生成/获取新题目... 实际ID: {actual_id}")
-        problem_token, problem_data = fetch_problem_from_pool(actual_id)
+        problem_token, problem_data = fetch_problem_from_pool(actual_id, session.get('user_id'))
 
         if not problem_data:
-            problem_token, problem_data = generate_and_cache_problem(actual_id)
+            problem_token, problem_data = generate_and_cache_problem(actual_id, session.get('user_id'))
 
         if not problem_data:
             flash('题目生成失败', 'danger')
@@ -2841,7 +5286,8 @@ def api_submit(problem_id):
         # 保存答题记录 - 使用更新后的累计尝试次数
         save_success = save_user_response(
             user_id, template_id, paper_id, problem_text, user_answers,
-            correct_answers, is_correct_list, total_attempts, time_taken, error_types
+            correct_answers, is_correct_list, total_attempts, time_taken, error_types,
+            variant_revision=problem_data.get('revision'), variant_seed=problem_data.get('seed')
         )
 
         if not save_success:
@@ -2893,9 +5339,9 @@ def api_submit(problem_id):
             next_problem_id = problem_id
 
             # 答错时生成新题目（不再限制尝试次数）
-            new_token, new_problem_data = fetch_problem_from_pool(actual_id)
+            new_token, new_problem_data = fetch_problem_from_pool(actual_id, user_id)
             if not new_problem_data:
-                new_token, new_problem_data = generate_and_cache_problem(actual_id)
+                new_token, new_problem_data = generate_and_cache_problem(actual_id, user_id)
 
             if new_problem_data:
                 # 更新session中的题目数据和正确答案
@@ -3250,6 +5696,9 @@ def admin_add_problem():
                         img_html = f'<div class="text-center mb-3"><img src="/static/images/{image_filename}" alt="{template_name}" class="problem-image img-fluid"><div class="image-caption text-muted">图：{template_name}</div></div>'
                         problem_text = img_html + problem_text
 
+            # 变量定义或公式无法编译时不保存
+            check_template_definition(variables, solution_formula, answer_count, answer_units)
+
             conn = get_db_connection()
             cursor = conn.cursor()
 
@@ -3259,12 +5708,14 @@ def admin_add_problem():
                 (template_name, problem_text, variables, solution_formula, answer_count, answer_units, difficulty, image_filename, paper_id)
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             """, (template_name, problem_text, variables, solution_formula, answer_count, answer_units, difficulty, image_filename, paper_id))
+            template_id = cursor.lastrowid
 
             conn.commit()
             cursor.close()
             conn.close()
 
-            flash('题目添加成功！', 'success')
+            submit_template_audit(template_id)
+            flash('题目添加成功！正在后台进行生成审核，结果见题目列表', 'success')
             return redirect(url_for('admin_manage_problems'))
 
         except Exception as e:
@@ -3298,8 +5749,12 @@ def admin_manage_problems():
         conn.close()
 
     display_mapping = get_problem_display_info(selected_paper_id, enabled_only=False)
+    audits = get_template_audits([template['id'] for template in templates])
     for template in templates:
         template['display_number'] = get_display_number(template['id'], template.get('paper_id'))
+        audit = audits.get(template['id'])
+        # 审核结果只对应保存时的修订，模板之后被改动过则不展示
+        template['audit'] = audit if audit and audit.get('revision') == get_template_revision(template) else None
 
     return render_template('admin_manage_problems.html',
                            templates=templates,
@@ -3354,16 +5809,22 @@ def admin_edit_problem(template_id):
                                               flags=re.DOTALL)
                         problem_text = img_html + problem_text
 
+            # 变量定义或公式无法编译时不保存
+            check_template_definition(variables, solution_formula, answer_count, answer_units)
+
             cursor.execute("""
                 UPDATE problem_templates 
                 SET template_name = %s, problem_text = %s, variables = %s, 
-                    solution_formula = %s, answer_count = %s, answer_units = %s, difficulty = %s, image_filename = %s, paper_id = %s
+                    solution_formula = %s, answer_count = %s, answer_units = %s, difficulty = %s, image_filename = %s, paper_id = %s,
+                    revision = revision + 1
                 WHERE id = %s
             """, (template_name, problem_text, variables, solution_formula, answer_count, answer_units, difficulty, image_filename, paper_id,
                   template_id))
 
             conn.commit()
-            flash('题目更新成功！', 'success')
+            publish_template_change(template_id)
+            submit_template_audit(template_id)
+            flash('题目更新成功！正在后台进行生成审核，结果见题目列表', 'success')
             return redirect(url_for('admin_manage_problems'))
 
         except Exception as e:
@@ -3405,6 +5866,7 @@ def admin_delete_problem(template_id):
         cursor.execute("DELETE FROM problem_templates WHERE id = %s", (template_id,))
 
         conn.commit()
+        publish_template_change(template_id)
 
         # 删除题目后刷新所有用户的完成状态和统计
         try:
@@ -4198,6 +6660,19 @@ def admin_delete_image(filename):
     return redirect(url_for('admin_image_manager'))
 
 
+@app.route('/admin/prewarm_status')
+@login_required
+def admin_prewarm_status():
+    """题目池预热进度"""
+    if session.get('username') != 'admin':
+        return jsonify({'success': False, 'message': '权限不足'}), 403
+    try:
+        status = get_prewarm_status()
+    except redis.RedisError as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+    return jsonify({'success': True, 'prewarm': status})
+
+
 @app.route('/health')
 def health_check():
     """健康检查端点"""
@@ -4234,6 +6709,7 @@ def exam_system_status():
         'active_users': active_users['active_users'],
         'today_attempts': today_attempts['total_attempts'],
         'server_time': datetime.now().isoformat(),
+        'compiled_cache': get_compiled_template_cache_stats(),
         'status': 'operational'
     })
 
@@ -4268,6 +6744,11 @@ if __name__ == '__main__':
     if not images_ok:
         print("⚠️ 警告: 部分图片文件缺失，请检查以上列表")
 
+    # 检查已有模板能否通过公式白名单
+    check_existing_templates()
+
+    start_template_change_listener()
+
     prewarm_flag = os.getenv('PREWARM') == '1' or os.getenv('PORT') == '5000'
     if prewarm_flag:
         prewarm_pools()
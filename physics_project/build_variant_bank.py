@@ -0,0 +1,50 @@
+"""考试前离线预生成题目变体库。
+
+为指定题库的每个模板生成大量已校验的变体（变量值 + 正确答案），保存为 .npy 文件。
+各 waitress 实例以内存映射方式读取，出题时直接随机取行，无需求值、重试或访问 Redis。
+
+用法：
+    python build_variant_bank.py <题库ID> [--size 20000] [--output variant_banks]
+"""
+import argparse
+import sys
+import time
+
+from app import VARIANT_BANK_DIR, build_variant_bank, get_exam_paper_by_id, get_problem_templates_by_paper
+
+
+def main():
+    parser = argparse.ArgumentParser(description='预生成题目变体库（.npy）')
+    parser.add_argument('paper_id', type=int, help='题库ID')
+    parser.add_argument('--size', type=int, default=20000, help='每个模板生成的变体数量')
+    parser.add_argument('--output', default=VARIANT_BANK_DIR, help='变体库输出目录')
+    args = parser.parse_args()
+
+    paper = get_exam_paper_by_id(args.paper_id)
+    if not paper:
+        print(f"❌ 题库 {args.paper_id} 不存在")
+        sys.exit(1)
+
+    templates = get_problem_templates_by_paper(paper_id=args.paper_id, enabled_only=False)
+    print(f"📦 题库「{paper['name']}」共 {len(templates)} 个模板，每个生成 {args.size} 个变体")
+
+    failed = 0
+    for template in templates:
+        started = time.time()
+        path, rows = build_variant_bank(template['id'], args.size, args.output)
+        if not path:
+            failed += 1
+            print(f"   ❌ 模板 {template['id']} {template['template_name']}: 公式无法编译，已跳过")
+            continue
+        print(f"   ✅ 模板 {template['id']} {template['template_name']}: {rows} 行 -> {path} "
+              f"({time.time() - started:.1f}s)")
+        if rows < args.size:
+            print(f"   ⚠️ 通过校验的变体不足 {args.size} 个，请检查变量范围配置")
+
+    if failed:
+        sys.exit(1)
+    print("🎉 变体库生成完成")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""批量导入题目模板包（YAML / JSON）。
+
+模板包格式见 docs/problem_generation_mvp.md 第 3、4 节：每个文件包含一个模板或模板列表。
+导入流程：
+    1. 解析并校验全部模板（变量定义、公式，并试编译、抽样求值），任一模板不合法时整体不写库；
+    2. 按题库分组，每个题库在一个事务内写入（同一题库中同名模板视为更新）；
+    3. 用进程池并行对每个模板做抽样冒烟测试（即生成审核），同时预热闭式解与学习到的变量范围缓存，
+       可选预生成 .npy 变体库，审核结果写入 Redis 供管理页面展示。
+
+用法：
+    python import_templates.py <模板目录> [--paper 题库名] [--workers N] [--bank-size 0] [--dry-run]
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app import (DEFAULT_EXAM_PAPER_NAME, TEMPLATE_AUDIT_HARD_LIMIT_SECONDS, TEMPLATE_CACHE, VARIANT_BANK_DIR,
+                 audit_template, build_variant_bank, check_template_definition, get_db_connection,
+                 get_template_revision, load_template_from_db, publish_template_change, run_with_hard_limit,
+                 save_template_audit)
+
+try:
+    import yaml
+except ImportError:  # 只导入 JSON 模板包时不需要 PyYAML
+    yaml = None
+
+TEMPLATE_PACKAGE_PATTERNS = ('*.yaml', '*.yml', '*.json')
+VARIABLE_SPEC_OPTIONS = ('step', 'decimals')
+
+
+def load_package_file(path):
+    """读取一个模板包文件，返回模板列表"""
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.json'):
+            data = json.load(f)
+        else:
+            if yaml is None:
+                raise ValueError("读取 YAML 模板需要安装 PyYAML（pip install pyyaml）")
+            data = yaml.safe_load(f)
+    if isinstance(data, dict):
+        data = data.get('templates', [data])
+    if not isinstance(data, list):
+        raise ValueError("模板包应为模板对象或模板列表")
+    return data
+
+
+def build_variable_spec(variables):
+    """把模板包中的变量列表转换为 variables 列的定义字符串，如 v0[5,30,step=0.5],t=v0/a"""
+    if isinstance(variables, str):
+        return variables
+    parts = []
+    for item in variables:
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        name = item['name']
+        if item.get('formula'):
+            parts.append(f"{name}={item['formula']}")
+        elif 'min' in item and 'max' in item:
+            bounds = [str(item['min']), str(item['max'])]
+            bounds += [f"{key}={item[key]}" for key in VARIABLE_SPEC_OPTIONS if item.get(key) is not None]
+            parts.append(f"{name}[{','.join(bounds)}]")
+        else:
+            parts.append(name)
+    return ','.join(parts)
+
+
+def build_template_row(item, default_paper):
+    """把模板包中的一个模板转换为 problem_templates 行，不合法时抛出 ValueError"""
+    name = item.get('template_name') or item.get('name')
+    problem_text = item.get('problem_text_template') or item.get('problem_text')
+    solution_formula = item.get('solution_formula')
+    if not name or not problem_text or not solution_formula or not item.get('variables'):
+        raise ValueError("模板必须包含 template_name、problem_text_template、variables 与 solution_formula")
+
+    variables = build_variable_spec(item['variables'])
+
+    units = item.get('answer_units') or []
+    if isinstance(units, str):
+        units = [unit.strip() for unit in units.split(',')]
+    answer_count = int(item.get('answer_count') or len(units) or 1)
+    if units and len(units) != answer_count:
+        raise ValueError(f"answer_units 数量（{len(units)}）与 answer_count（{answer_count}）不一致")
+
+    constraints = item.get('answer_constraints') or {}
+    if not isinstance(constraints, dict):
+        raise ValueError("answer_constraints 应为对象")
+    if 'allow_negative' in constraints:
+        constraints = dict(constraints)
+        constraints.setdefault('non_negative', not constraints.pop('allow_negative'))
+
+    answer_units = ','.join(units) if units else None
+    answer_constraints = json.dumps(constraints, ensure_ascii=False) if constraints else None
+    check_template_definition(variables, solution_formula, answer_count, answer_units, answer_constraints)
+
+    return {
+        'paper': item.get('paper') or default_paper,
+        'template_name': str(name),
+        'problem_text': problem_text,
+        'variables': variables,
+        'solution_formula': solution_formula,
+        'answer_count': answer_count,
+        'answer_units': answer_units,
+        'answer_constraints': answer_constraints,
+        'difficulty': item.get('difficulty') or 'medium',
+        'image_filename': item.get('image_filename'),
+    }
+
+
+def load_template_package(directory, default_paper):
+    """解析目录下全部模板文件，返回 (模板行列表, 错误列表)"""
+    paths = sorted(path for pattern in TEMPLATE_PACKAGE_PATTERNS
+                   for path in glob.glob(os.path.join(directory, '**', pattern), recursive=True))
+    rows, errors = [], []
+    for path in paths:
+        try:
+            items = load_package_file(path)
+        except Exception as e:
+            errors.append(f"{path}: {e}")
+            continue
+        for index, item in enumerate(items):
+            try:
+                rows.append(build_template_row(item, default_paper))
+            except Exception as e:
+                label = item.get('template_name') or item.get('template_id') or f"#{index + 1}"
+                errors.append(f"{path} [{label}]: {e}")
+    return rows, errors
+
+
+def save_paper_templates(paper_name, rows):
+    """在一个事务内写入同一题库的模板，返回模板ID列表（已存在的模板提交后通知各实例清除缓存）"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("数据库连接失败")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT id FROM exam_papers WHERE name = %s", (paper_name,))
+        paper = cursor.fetchone()
+        if paper:
+            paper_id = paper[0]
+        else:
+            cursor.execute("INSERT INTO exam_papers (name, description, is_enabled) VALUES (%s, %s, TRUE)",
+                           (paper_name, '模板包导入'))
+            paper_id = cursor.lastrowid
+
+        template_ids = []
+        updated_ids = []
+        for row in rows:
+            values = (row['problem_text'], row['variables'], row['solution_formula'], row['answer_count'],
+                      row['answer_units'], row['answer_constraints'], row['difficulty'], row['image_filename'])
+            cursor.execute("SELECT id FROM problem_templates WHERE paper_id = %s AND template_name = %s",
+                           (paper_id, row['template_name']))
+            existing = cursor.fetchone()
+            if existing:
+                cursor.execute("""
+                    UPDATE problem_templates
+                    SET problem_text = %s, variables = %s, solution_formula = %s, answer_count = %s,
+                        answer_units = %s, answer_constraints = %s, difficulty = %s, image_filename = %s,
+                        revision = revision + 1
+                    WHERE id = %s
+                """, values + (existing[0],))
+                template_ids.append(existing[0])
+                updated_ids.append(existing[0])
+            else:
+                cursor.execute("""
+                    INSERT INTO problem_templates
+                    (problem_text, variables, solution_formula, answer_count, answer_units,
+                     answer_constraints, difficulty, image_filename, template_name, paper_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, values + (row['template_name'], paper_id))
+                template_ids.append(cursor.lastrowid)
+        conn.commit()
+        for template_id in updated_ids:
+            publish_template_change(template_id)
+        return template_ids
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def smoke_test_template(template, bank_size, bank_dir):
+    """进程池子进程中执行：抽样冒烟测试（生成审核），可选预生成变体库"""
+    TEMPLATE_CACHE[template['id']] = template
+    result = run_with_hard_limit(TEMPLATE_AUDIT_HARD_LIMIT_SECONDS, audit_template, template['id'])
+    if bank_size and result['status'] != 'failed':
+        path, rows = build_variant_bank(template['id'], bank_size, bank_dir)
+        result['bank'] = {'path': path, 'rows': rows}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入题目模板包（YAML / JSON）')
+    parser.add_argument('directory', help='模板包目录（递归读取 *.yaml / *.yml / *.json）')
+    parser.add_argument('--paper', default=DEFAULT_EXAM_PAPER_NAME, help='模板未指定 paper 时写入的题库名')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='冒烟测试进程数')
+    parser.add_argument('--bank-size', type=int, default=0, help='每个模板预生成的变体数量（0 表示不生成）')
+    parser.add_argument('--output', default=VARIANT_BANK_DIR, help='变体库输出目录')
+    parser.add_argument('--dry-run', action='store_true', help='只解析和校验，不写数据库')
+    args = parser.parse_args()
+
+    rows, errors = load_template_package(args.directory, args.paper)
+    for error in errors:
+        print(f"   ❌ {error}")
+    if errors:
+        print(f"❌ {len(errors)} 个模板校验失败，未写入数据库")
+        sys.exit(1)
+    if not rows:
+        print(f"❌ 目录 {args.directory} 中没有模板")
+        sys.exit(1)
+    print(f"📦 共解析 {len(rows)} 个模板，校验通过")
+    if args.dry_run:
+        return
+
+    papers = {}
+    for row in rows:
+        papers.setdefault(row['paper'], []).append(row)
+    template_ids = []
+    for paper_name, paper_rows in papers.items():
+        try:
+            template_ids.extend(save_paper_templates(paper_name, paper_rows))
+        except Exception as e:
+            print(f"   ❌ 题库「{paper_name}」写入失败，已回滚: {e}")
+            sys.exit(1)
+        print(f"   ✅ 题库「{paper_name}」写入 {len(paper_rows)} 个模板")
+
+    templates = [template for template in map(load_template_from_db, template_ids) if template]
+    print(f"🔥 开始冒烟测试（{args.workers} 个进程）")
+    started = time.time()
+    failed = 0
+    # 与 app 一致使用 spawn：校验阶段已启动 app 的进程池与线程，不能再 fork
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(smoke_test_template, template, args.bank_size, args.output): template
+                   for template in templates}
+        for future in as_completed(futures):
+            template = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'status': 'failed', 'error': str(e)}
+            save_template_audit(template['id'], get_template_revision(template), result)
+            if result['status'] == 'failed':
+                failed += 1
+                print(f"   ❌ 模板 {template['id']} {template['template_name']}: {result.get('error')}")
+            else:
+                print(f"   ✅ 模板 {template['id']} {template['template_name']}: "
+                      f"平均 {result['mean_ms']}ms，拒绝率 {result['rejection_rate']:.0%}"
+                      + (f"，变体库 {result['bank']['rows']} 行" if result.get('bank') else ''))
+
+    print(f"⏱️ 冒烟测试耗时 {time.time() - started:.1f}s")
+    if failed:
+        sys.exit(1)
+    print("🎉 模板包导入完成")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""题目池补货守护进程。
+
+订阅请求线程发布的低水位事件（POOL_LOW_WATER_CHANNEL），并定期检查已开启题库中全部模板（以及有出池记录的模板）
+的题目池长度，低于低水位时在后台进程池中把题目池补满到目标容量（均按该模板的出池速率 EWMA 自适应，见 get_pool_targets）。
+定期检查不依赖 exam:pool:* 列表是否存在（Redis 会删除空列表），错过低水位事件或新增模板时也能补货。
+各实例设置 POOL_REFILL_DAEMON=1 时（start_multi_4.bat 会同时启动本进程）
+请求线程只在池为空时才在时间预算内兜底生成题目；未设置时由各实例在本地进程池中补货。
+
+用法：
+    python -m refill_daemon [--scan-interval 30]
+"""
+import argparse
+import re
+import sys
+import time
+
+import redis
+
+from app import (GENERATION_HARD_LIMIT_SECONDS, POOL_LOW_WATER_CHANNEL, get_generation_breaker_key, get_pool_grid_key,
+                 get_pool_key, get_pool_low_water, get_pool_targets, get_problem_templates_by_paper, logger,
+                 redis_client, refill_problem_pool, start_template_change_listener)
+
+DEMAND_KEY_PATTERN = re.compile(r'^exam:pool:(\d+):demand$')
+RECONNECT_DELAY_SECONDS = 5
+
+
+def list_template_ids():
+    """需要检查的模板ID：已开启题库中的全部模板，加上 Redis 中有出池记录的模板（数据库不可用时仍可补货）"""
+    template_ids = {template['id'] for template in get_problem_templates_by_paper()}
+    for key in redis_client.scan_iter(match='exam:pool:*:demand', count=500):
+        match = DEMAND_KEY_PATTERN.match(key)
+        if match:
+            template_ids.add(int(match.group(1)))
+    return template_ids
+
+
+def refill_low_pools(template_ids):
+    """一次往返读取各模板的池深度、熔断状态、网格模式标记与出池速率，低于水位、未熔断且使用题目池的提交补货任务
+    （同一模板同时只执行一个任务）"""
+    template_ids = list(template_ids)
+    pipe = redis_client.pipeline(transaction=False)
+    for template_id in template_ids:
+        pipe.llen(get_pool_key(template_id))
+        pipe.exists(get_generation_breaker_key(template_id))
+        pipe.exists(get_pool_grid_key(template_id))
+    targets, results = get_pool_targets(template_ids, pipe)
+    for template_id, pool_size, suspended, grid_mode, target in zip(
+            template_ids, results[::3], results[1::3], results[2::3], targets):
+        # 网格模式的模板直接从合格组合表出题，不使用题目池
+        if suspended or grid_mode or pool_size >= get_pool_low_water(target):
+            continue
+        count = target - pool_size
+        print(f"🔄 模板 {template_id} 池剩余 {pool_size}，补货 {count} 道（目标 {target}）")
+        # 后台补货不占用请求的时间预算，只有失败或超过硬性上限才计入熔断
+        refill_problem_pool(template_id, count, timeout=0, time_budget=GENERATION_HARD_LIMIT_SECONDS)
+
+
+def run(scan_interval):
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(POOL_LOW_WATER_CHANNEL)
+    print(f"👂 已订阅低水位事件 {POOL_LOW_WATER_CHANNEL}，每 {scan_interval}s 检查一次全部模板的题目池")
+    next_scan = 0
+    while True:
+        if time.time() >= next_scan:
+            refill_low_pools(sorted(list_template_ids()))
+            next_scan = time.time() + scan_interval
+        message = pubsub.get_message(timeout=1.0)
+        if message:
+            try:
+                template_id = int(message['data'])
+            except (TypeError, ValueError):
+                continue
+            refill_low_pools([template_id])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='题目池补货守护进程')
+    parser.add_argument('--scan-interval', type=float, default=30, help='检查全部模板题目池的间隔（秒）')
+    args = parser.parse_args()
+
+    print("🚀 启动题目池补货守护进程...")
+    # 管理员修改模板后清除缓存，之后按新修订生成
+    start_template_change_listener()
+    while True:
+        try:
+            run(args.scan_interval)
+        except redis.ConnectionError as e:
+            logger.error("Redis 连接中断，%s 秒后重连: %s", RECONNECT_DELAY_SECONDS, e)
+            time.sleep(RECONNECT_DELAY_SECONDS)
+        except KeyboardInterrupt:
+            print("👋 补货守护进程已退出")
+            sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,25 +8,29 @@ echo =========================================
 
 REM 启动 5000（主实例，建议第一个启动）
 start "Waitress :5000" cmd /k ^
-"set PORT=5000 && python start_server.py"
+"set PORT=5000 && set POOL_REFILL_DAEMON=1 && python start_server.py"
 
 timeout /t 2 >nul
 
 REM 启动 5001
 start "Waitress :5001" cmd /k ^
-"set PORT=5001 && python start_server.py"
+"set PORT=5001 && set POOL_REFILL_DAEMON=1 && python start_server.py"
 
 timeout /t 2 >nul
 
 REM 启动 5002
 start "Waitress :5002" cmd /k ^
-"set PORT=5002 && python start_server.py"
+"set PORT=5002 && set POOL_REFILL_DAEMON=1 && python start_server.py"
 
 timeout /t 2 >nul
 
 REM 启动 5003
 start "Waitress :5003" cmd /k ^
-"set PORT=5003 && python start_server.py"
+"set PORT=5003 && set POOL_REFILL_DAEMON=1 && python start_server.py"
+
+REM 启动题目池补货守护进程（各实例设置了 POOL_REFILL_DAEMON=1，只发布低水位事件）
+start "Refill daemon" cmd /k ^
+"python refill_daemon.py"
 
 echo =========================================
 echo 所有实例已启动
@@ -1,8 +1,10 @@
 import os
 import sys
 import logging
+import threading
 from datetime import datetime
-from app import app, initialize_database, create_admin_user, repair_database
+from app import (app, initialize_database, create_admin_user, repair_database, prewarm_pools,
+                 start_template_change_listener, check_existing_templates)
 
 
 # 配置日志
@@ -49,6 +51,17 @@ if __name__ == '__main__':
         create_admin_user()
         repair_database()
 
+        # 已有模板按公式白名单检查，不合法的只记录日志（出题时返回失败）
+        check_existing_templates()
+
+        # 订阅模板修改通知：任一实例编辑模板后，所有实例清除该模板的缓存
+        start_template_change_listener()
+
+        # 预热题目池：多实例同时启动时只有取得 Redis 预热锁的实例执行，后台线程运行，不阻塞服务启动
+        # 进度可通过 /admin/prewarm_status 查看；设置 PREWARM=0 可关闭
+        if os.environ.get('PREWARM', '1') != '0':
+            threading.Thread(target=prewarm_pools, name='prewarm', daemon=True).start()
+
         # 生产环境使用 Waitress
         from waitress import serve
 